@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Reading of the obsolescence chains CSV files written by
+get_obsolescence_chains.py and resolve_unresolved_dois.py, for the scripts
+that consume them.
+
+The file is read once, as a stream, and its rows are yielded as they are
+parsed, so a consumer keeps only the records it needs. The records are
+named tuples, which take no more memory than plain tuples. Every value is
+interned: a DOI or PID appears in up to three rows (its own, and those of
+the revisions before and after it), and interning keeps a single copy of
+each, along with a single empty string.
+
+A file that can't be used, because it's missing, has UNRESOLVED values where
+resolved chains are needed, or has a row with the wrong number of columns,
+raises a Chains_file_error, giving the line, as the offending row is reached.
+Scripts read the records they need in that one pass, before any network work
+starts, inside stop_on_chains_file_error, so that they stop with a message and
+a non-zero exit status rather than partway through.
+"""
+
+import collections
+import contextlib
+import csv
+import os
+import sys
+from typing import Iterator
+
+
+UNRESOLVED = 'UNRESOLVED'
+COLUMNS = ('doi', 'obsoletes', 'obsoletedBy', 'metadataPID', 'metadataObsoletesPID',
+           'metadataObsoletedByPID')
+
+Chain_record = collections.namedtuple('Chain_record', COLUMNS)
+
+
+class Chains_file_error(Exception):
+    """ Raised for an obsolescence chains CSV file that can't be used. """
+
+
+def read_chains(chains_filename: str, resolved: bool = True) -> Iterator[Chain_record]:
+    """
+    Yield the records of the obsolescence chains CSV file, in file order.
+    Raises Chains_file_error if the file is missing, for a row with the wrong
+    number of columns, or, if resolved is True, with UNRESOLVED entries.
+    """
+    intern = sys.intern
+    if not os.path.isfile(chains_filename):
+        raise Chains_file_error('{} not found. Exiting.'.format(chains_filename))
+    with open(chains_filename, mode='r', newline='') as chains_file:
+        csvreader = csv.reader(chains_file, delimiter=',')
+        # skip the header
+        next(csvreader, None)
+        for row in csvreader:
+            if not row:
+                continue
+            if len(row) != len(COLUMNS):
+                raise Chains_file_error('{}, line {}: {} columns found, {} expected. Exiting.'.format(
+                    chains_filename, csvreader.line_num, len(row), len(COLUMNS)))
+            if resolved and UNRESOLVED in row:
+                raise Chains_file_error(
+                    '{}, line {}: UNRESOLVED DOIs found. Please run resolve_unresolved_dois.py '
+                    'and use its output. Exiting.'.format(chains_filename, csvreader.line_num))
+            yield Chain_record._make([intern(value) for value in row])
+
+
+@contextlib.contextmanager
+def stop_on_chains_file_error():
+    """
+    Context manager for reading obsolescence chains CSV files. If one can't be
+    used, print the message and exit with status 1.
+    """
+    try:
+        yield
+    except Chains_file_error as error:
+        print(error, flush=True)
+        exit(1)
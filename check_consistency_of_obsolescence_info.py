@@ -1,15 +1,22 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import asyncio
 import collections
-import requests
+import sys
+from typing import Dict, List
 
 import click
 
+from obsolescence_sources import METADATA_PID_PREFIX, PASTA_source
+from request_scheduler import RequestScheduler, Scheduler_settings, scheduler_options
+
 
 @click.command()
 @click.argument('obsolescence_info_sorted_csv_file')
-def check_consistency_of_obsolescence_info(obsolescence_info_sorted_csv_file: str):
+@scheduler_options()
+def check_consistency_of_obsolescence_info(obsolescence_info_sorted_csv_file: str,
+                                           scheduler_settings: Scheduler_settings):
     """
     Read CSV file with pid, obsoletes, obsoletedBy obtained by running get_system_metadata_obsolescence_info.py.
 I.e., this file contains the currently existing obsolescence info on a MN or CN of interest. File is assumed to
@@ -19,13 +26,20 @@ consistency with the versions lists in PASTA.
 
 Arguments: \n
         OBSOLESCENCE_INFO_SORTED_CSV_FILE: sorted CSV file with PID, obsoletes, obsoletedBy
+
+        The packages' lists of versions are requested from PASTA concurrently.
     """
-    main(obsolescence_info_sorted_csv_file)
+
+    # Check the Python version
+    if sys.version_info < (3, 7):
+        print("Requires Python 3.7 or later")
+        exit(0)
+
+    main(obsolescence_info_sorted_csv_file, scheduler_settings)
 
 
 def parsePID(pid: str):
-    PASTA_PREFIX = 'https://pasta.lternet.edu/package/metadata/eml/'
-    identifier, scope, version = pid.strip().replace(PASTA_PREFIX, '').split('/')
+    identifier, scope, version = pid.strip().replace(METADATA_PID_PREFIX, '').split('/')
     return ('{}/{}'.format(identifier, scope), version)
 
 
@@ -36,7 +50,36 @@ def getVersion(pid: str):
     return version
 
 
-def main(input_filename: str):
+async def check_against_pasta(packages: Dict[str, Dict[str, List[str]]], scheduler_settings: Scheduler_settings):
+    """
+    Compare each package's versions with its list of revisions in PASTA, keeping up
+    to concurrency requests in flight and limiting the request rate so we don't do
+    a denial of service attack on PASTA.
+    """
+    count = 0
+    pasta = PASTA_source()
+
+    async def check_and_count(package_key: str):
+        nonlocal count
+        try:
+            revisions = await pasta.get_revisions(package_key, scheduler)
+        except:
+            print('Exception: ', sys.exc_info()[0], flush=True)
+            print('Gave up getting the PASTA revisions of', package_key, flush=True)
+            return
+        pasta_versions = ' '.join(str(revision) for revision in revisions)
+        versions = ' '.join(packages[package_key]['versions'])
+        if pasta_versions != versions:
+            print('{} - PASTA: {} - Found: {}'.format(package_key, pasta_versions, versions), flush=True)
+        count += 1
+        if count % 100 == 0:
+            print('count={}'.format(count), flush=True)
+
+    async with RequestScheduler(scheduler_settings) as scheduler:
+        await scheduler.run(check_and_count, packages)
+
+
+def main(input_filename: str, scheduler_settings: Scheduler_settings):
 
     # For simplicity, assume the input is sorted by pid
     # Read the input file:  pid, obsoletes, obsoletedBy
@@ -92,18 +135,8 @@ def main(input_filename: str):
                                                                 ' '.join(package['versions'][1:])))
     # Check against PASTA
     print()
-    print('Checking against PASTA... {} packages to check'.format(len(packages)))
-    count = 0
-    for package_key in packages:
-        count += 1
-        package = packages[package_key]
-        url = "https://pasta.lternet.edu/package/eml/" + package_key
-        pasta_versions = requests.get(url).text.replace('\n', ' ')
-        versions = ' '.join(package['versions'])
-        if pasta_versions != versions:
-            print('{} - PASTA: {} - Found: {}'.format(package_key, pasta_versions, versions))
-        if count % 100 == 0:
-            print('count={}'.format(count))
+    print('Checking against PASTA... {} packages to check'.format(len(packages)), flush=True)
+    asyncio.run(check_against_pasta(packages, scheduler_settings))
 
 
 if __name__ == '__main__':
@@ -2,19 +2,16 @@
 # -*- coding: utf-8 -*-
 
 import collections
-import csv
 from datetime import datetime
 import sys
-import time
-from typing import List
-import urllib.parse
+from typing import List, Tuple
 
-from aiohttp import ClientSession
 import asyncio
 import click
-import difflib
-from namedlist import namedlist
-import xml.etree.ElementTree as ET
+
+from chains_csv import read_chains, stop_on_chains_file_error
+from obsolescence_sources import Sysmeta_source, check_consistency, obsolescence_values
+from request_scheduler import RequestScheduler, Scheduler_settings, scheduler_options
 
 
 @click.command()
@@ -27,8 +24,10 @@ import xml.etree.ElementTree as ET
 @click.option("-n", default=0, help="max number of checks to make")
 @click.option("--deep", default=False, is_flag=True, help="check all objects, "
     "not just objects expected to have obsolescence information")
+@scheduler_options(concurrency=5, rate=5.0)
 def check_coordinating_node_entries(
-    obsolescence_chains_csv_file: str, m: str, n: str, deep: bool
+    obsolescence_chains_csv_file: str, m: str, n: str, deep: bool,
+    scheduler_settings: Scheduler_settings
 ):
     """
     Check obsolescence chains in eml system metadata on DataONE 
@@ -47,126 +46,78 @@ get_obsolescence_chains.py, followed by resolve_unresolved_dois.py
         print("Requires Python 3.7 or later")
         exit(0)
 
-    main(obsolescence_chains_csv_file, m, int(n), deep)
-
+    main(obsolescence_chains_csv_file, m, int(n), deep, scheduler_settings)
 
-UNRESOLVED = "UNRESOLVED"
-MAX_RETRIES = 3
-BURST_SIZE = 5
 
+# The (obsoletes, obsoletedBy) values found in each PID's metadata
 metadata_records = collections.OrderedDict()
 
 doi_records = collections.OrderedDict()
-DOI_record = namedlist('DOI_record', 
-                      'doi obsoletes obsoletedBy metadataPID metadataObsoletesPID metadataObsoletedByPID',
-                      default=None)
 
 
-async def get_metadata(mn: str, pid: str, session: ClientSession, **kwargs) -> str:
+async def save_metadata(source: Sysmeta_source, pid: str, scheduler: RequestScheduler):
     """
-    Retrieve system metadata for a package. This is the metadata to which obsolescence
-    information may need to be added. Return the response text (the metadata).
+    Check the returned metadata as soon as it arrives and save just its obsoletes
+    and obsoletedBy values in the metadata_records dict, so only the metadata in
+    flight is held in memory. Handle needed retries, if any.
     """
-    metadata_url = 'https://{}/cn/v2/meta/{}'.format(mn, urllib.parse.quote_plus(pid))
-    resp = await session.request(method='GET', url=metadata_url, **kwargs)
-    resp.raise_for_status()
-    return await resp.text()
+    global metadata_records
+    try:
+        metadata_response = await source.get_metadata(pid, scheduler)
+    except:
+        print('Exception: ', sys.exc_info()[0], flush=True)
+        print('Gave up getting metadata for', pid, flush=True)
+        return
+    metadata_records[pid] = obsolescence_values(metadata_response)
+    check_for_consistency(doi_records[pid], metadata_records[pid], metadata_response)
 
 
-async def save_metadata(mn: str, pid: str, session: ClientSession):
-    """
-    Save the returned metadata in the metadata_records dict. Handle needed retries, if any.
+async def run_get_metadata_tasks(mn: str, pids: List[str], scheduler_settings: Scheduler_settings):
     """
-    global metadata_records
-    retries = 0
-    while retries < MAX_RETRIES:
-        try:
-            metadata_response = await get_metadata(mn, pid, session)
-            break  # no exception, so break out of the retry loop
-        except:
-            print('Exception: ', sys.exc_info()[0], flush=True)
-            retries += 1
-            print('retries:', retries, ' ', pid, ' getting metadata', flush=True)
-            if retries >= MAX_RETRIES:
-                print('Reached max retries getting metadata. Giving up...', flush=True)
-                return
-            time.sleep(1)
-    metadata_records[pid] = metadata_response
-
-
-async def run_get_metadata_tasks(mn: str, pids: List[str]):
+    Get metadata for a list of pids, check it and save its obsolescence information
+    in the metadata_records table.
+    Up to concurrency requests are kept in flight, and the request rate is
+    limited so we don't do a denial of service attack on the node.
     """
-    Fire off a list of tasks to get metadata and save it in the metadata_records
-    table.
-    """
-    async with ClientSession() as session:
-        tasks = [save_metadata(mn, pid, session) for pid in pids]
-        await asyncio.gather(*tasks)
+    count = 0
+    source = Sysmeta_source('CN', mn, 'cn')
+
+    async def get_and_count(pid: str):
+        nonlocal count
+        await save_metadata(source, pid, scheduler)
+        count += 1
+        if count % 1000 == 0:   # Just so we can see signs of life...
+            print('count = {}, time = {}'.format(count, datetime.now().strftime("%H:%M:%S")), flush=True)
+
+    async with RequestScheduler(scheduler_settings) as scheduler:
+        await scheduler.run(get_and_count, pids)
+    print('count = {}, time = {}'.format(count, datetime.now().strftime("%H:%M:%S")), flush=True)
 
 
-def check_for_consistency(doi_record, metadata) -> bool:
-    """ Check metadata xml for agreement with the DOI record. """
-    pid = doi_record.metadataPID
+def check_for_consistency(doi_record, obsolescence: Tuple[str, str], metadata: str) -> bool:
+    """
+    Check the obsoletes and obsoletedBy values found in the metadata xml for
+    agreement with the DOI record, printing the metadata if they don't agree.
+    """
     if not metadata:
-        print('Metadata not available for pid', pid, flush=True)
+        print('Metadata not available for pid', doi_record.metadataPID, flush=True)
         return False
+    expected = (doi_record.metadataObsoletesPID, doi_record.metadataObsoletedByPID)
+    if check_consistency(doi_record.metadataPID, expected, obsolescence):
+        return True
+    print('\n{}'.format(metadata))
+    return False
 
-    expect_obsoletes = doi_record.metadataObsoletesPID
-    expect_obsoletedBy = doi_record.metadataObsoletedByPID
-    ok = True
-
-    root = ET.fromstring(metadata)
-    obsoletes_elements = root.findall('obsoletes')
-    if len(obsoletes_elements) > 0:
-        have_obsoletes = obsoletes_elements[0].text
-    else:
-        have_obsoletes = ''
-    obsoletedBy_elements = root.findall('obsoletedBy')
-    if len(obsoletedBy_elements) > 0:
-        have_obsoletedBy = obsoletedBy_elements[0].text
-    else:
-        have_obsoletedBy = ''
-
-    if expect_obsoletes != have_obsoletes or expect_obsoletedBy != have_obsoletedBy:
-        print(pid, flush=True)
-
-    if expect_obsoletes != have_obsoletes:
-        print('   Expected obsoletes={}'.format(ascii(expect_obsoletes)), flush=True)
-        print('   Found obsoletes   ={}'.format(ascii(have_obsoletes)), flush=True)
-        print('\n'.join(difflib.ndiff([expect_obsoletes], [have_obsoletes])))
-        ok = False
-    if expect_obsoletedBy != have_obsoletedBy:
-        print('   Expected obsoletedBy={}'.format(ascii(expect_obsoletedBy)), flush=True)
-        print('   Found obsoletedBy   ={}'.format(ascii(have_obsoletedBy)), flush=True)
-        print('\n'.join(difflib.ndiff([expect_obsoletedBy], [have_obsoletedBy])))
-        ok = False
-    if not ok:
-        print('\n{}'.format(metadata))
-    return ok
-
-
-def main(obsolescence_chains_csv_file: str, mn: str, max_n: int, deep: bool):
 
+def main(obsolescence_chains_csv_file: str, mn: str, max_n: int, deep: bool,
+         scheduler_settings: Scheduler_settings):
     global doi_records
     global metadata_records
     global sent_count
 
     # Read in the DOI records
-    with open(obsolescence_chains_csv_file, 'r') as input_csv_file:
-        # Check for UNRESOLVED entries
-        if input_csv_file.read().find(UNRESOLVED) > -1:
-            print(
-                'UNRESOLVED DOIs found. Please run resolve_unresolved_dois.py '
-                'and use its output. Exiting.', flush=True
-            )
-            exit(0)
-
-        input_csv_file.seek(0)
-        csvreader = csv.reader(input_csv_file, delimiter=',')
-        # skip the header
-        next(csvreader)
-        for row in csvreader:
-            doi_record = DOI_record(*row)
+    with stop_on_chains_file_error():
+        for doi_record in read_chains(obsolescence_chains_csv_file):
             if deep or doi_record.metadataObsoletesPID or doi_record.metadataObsoletedByPID:
                 pid = doi_record.metadataPID
                 doi_records[pid] = doi_record
@@ -176,29 +127,13 @@ def main(obsolescence_chains_csv_file: str, mn: str, max_n: int, deep: bool):
 
     print(len(doi_records), flush=True)
 
-    # Go get the metadata that needs to be modified
-    print('\nGetting metadata', flush=True)
-    count = 0
-    pids = []
-    for _, doi_record in doi_records.items():
-        pids.append(doi_record.metadataPID)
-        count += 1
-        # Access the member node in bursts so we don't do a denial of service attack on it
-        if count % BURST_SIZE == 0:
-            # Create tasks to get metadata
-            asyncio.run(run_get_metadata_tasks(mn, pids))
-            time.sleep(1)
-            pids = []
-        if count % 1000 == 0:   # Just so we can see signs of life...
-            print('count = {}, time = {}'.format(count, datetime.now().strftime("%H:%M:%S")), flush=True)
-        if max_n > 0 and count >= max_n:
-            break
-    asyncio.run(run_get_metadata_tasks(mn, pids))
-    print('count = {}, time = {}'.format(count, datetime.now().strftime("%H:%M:%S")), flush=True)
-
-    # Now that we've got the metadata, check it against the expected values
-    print('\nChecking metadata', flush=True)
+    # Go get the metadata and check it against the expected values as it arrives
+    print('\nGetting and checking metadata', flush=True)
     print(flush=True)
+    pids = [doi_record.metadataPID for doi_record in doi_records.values()]
+    if max_n > 0:
+        pids = pids[:max_n]
+    asyncio.run(run_get_metadata_tasks(mn, pids, scheduler_settings))
 
     error_count = 0
 
@@ -216,13 +151,14 @@ def main(obsolescence_chains_csv_file: str, mn: str, max_n: int, deep: bool):
         print(metadata_pids - doi_pids, flush=True)
         print(flush=True)
 
+    # The differences have been printed as the metadata arrived
     for doi, doi_record in doi_records.items():
         pid = doi_record.metadataPID
         if pid in metadata_records:
             metadata_record = metadata_records[pid]
-            if metadata_record:
-                if not check_for_consistency(doi_record, metadata_record):
-                    error_count += 1
+            if metadata_record and \
+                    metadata_record != (doi_record.metadataObsoletesPID, doi_record.metadataObsoletedByPID):
+                error_count += 1
     print('\n{} errors found'.format(error_count), flush=True)
 
 
@@ -2,19 +2,19 @@
 # -*- coding: utf-8 -*-
 
 import collections
-import csv
 from datetime import datetime
 import sys
-import time
-from typing import List
-import urllib.parse
+from typing import List, Tuple
 
-from aiohttp import ClientSession
 import asyncio
 import click
-import difflib
-from namedlist import namedlist
-import xml.etree.ElementTree as ET
+
+from chains_csv import read_chains, stop_on_chains_file_error
+from http_cache import ResponseCache, cache_options
+from obsolescence_sources import Sysmeta_source, check_consistency, obsolescence_values
+from request_scheduler import RequestScheduler, Scheduler_settings, scheduler_options
+from sysmeta_fingerprints import Fingerprint_store, fingerprint, fingerprint_store_option, run_started, \
+    unchanged_pids
 
 
 @click.command()
@@ -28,8 +28,16 @@ import xml.etree.ElementTree as ET
 @click.option("-n", default=0, help="max number of checks to make")
 @click.option("--deep", default=False, is_flag=True, help="check all metadata, "
     "not just metadata expected to have obsolescence information")
+@click.option("--verify", default=None, help="CSV file of the PIDs updated by "
+    "update_obsolescence_chains.py --updated. Only they are checked.")
+@click.option("--neighbors", default=False, is_flag=True, help="with --verify, also check "
+    "the PIDs before and after each updated PID in its obsolescence chain")
+@scheduler_options()
+@cache_options
+@fingerprint_store_option
 def check_metadata_obsolescence_entries(
-    obsolescence_chains_csv_file: str, m: str, n: str, deep: bool
+    obsolescence_chains_csv_file: str, m: str, n: str, deep: bool, verify: str, neighbors: bool,
+    scheduler_settings: Scheduler_settings, cache: str, cache_ttl: float, fingerprints: str
 ):
     """
     Check obsolescence chains in eml system metadata against expected
@@ -40,6 +48,15 @@ def check_metadata_obsolescence_entries(
 Arguments: \n
         OBSOLESCENCE_CHAINS_CSV_FILE (input): obsolescence chains in the form of output from
 get_obsolescence_chains.py and resolve_unresolved_dois.py
+
+        With --fingerprints, the fingerprints of the metadata found to be as
+        expected are saved in the given file, shared with update_obsolescence_chains.py,
+        and later runs skip the PIDs whose metadata hasn't changed since.
+
+        With --verify UPDATED_CSV_FILE, only the PIDs whose metadata
+        update_obsolescence_chains.py updated are checked, against the values it
+        expected them to get, and with --neighbors, the PIDs they obsolete or
+        are obsoleted by as well, against OBSOLESCENCE_CHAINS_CSV_FILE.
     """
 
     # Check the Python version
@@ -47,154 +64,166 @@ get_obsolescence_chains.py and resolve_unresolved_dois.py
         print("Requires Python 3.7 or later")
         exit(0)
 
-    main(obsolescence_chains_csv_file, m, int(n), deep)
+    main(obsolescence_chains_csv_file, m, int(n), deep, scheduler_settings,
+         cache, cache_ttl, fingerprints, verify, neighbors)
 
 
-UNRESOLVED = "UNRESOLVED"
-MAX_RETRIES = 3
-BURST_SIZE = 10
+# Stands in for the metadata of PIDs skipped because it hasn't changed since it was verified
+UNCHANGED = "UNCHANGED"
 
 
+# The (obsoletes, obsoletedBy) values found in each PID's metadata, or UNCHANGED
 metadata_records = collections.OrderedDict()
 
 doi_records = collections.OrderedDict()
-DOI_record = namedlist('DOI_record', 
-                      'doi obsoletes obsoletedBy metadataPID metadataObsoletesPID metadataObsoletedByPID',
-                      default=None)
-
 
-async def get_metadata(mn: str, pid: str, session: ClientSession, **kwargs) -> str:
-    """
-    Retrieve system metadata for a package. This is the metadata to which obsolescence
-    information may need to be added. Return the response text (the metadata).
-    """
-    metadata_url = 'https://{}/mn/v2/meta/{}'.format(mn, urllib.parse.quote_plus(pid))
-    resp = await session.request(method='GET', url=metadata_url, **kwargs)
-    resp.raise_for_status()
-    return await resp.text()
+# Fingerprints of the metadata found to be as expected, keyed by PID
+metadata_fingerprints = {}
 
 
-async def save_metadata(mn: str, pid: str, session: ClientSession):
+async def save_metadata(source: Sysmeta_source, pid: str, scheduler: RequestScheduler, verified: str = None):
     """
-    Save the returned metadata in the metadata_records dict. Handle needed retries, if any.
+    Check the returned metadata as soon as it arrives and save just its obsoletes
+    and obsoletedBy values in the metadata_records dict, so only the metadata in
+    flight is held in memory. If verified is given, the fingerprint of metadata
+    found to be as expected is saved too. Handle needed retries, if any.
     """
     global metadata_records
-    retries = 0
-    while retries < MAX_RETRIES:
-        try:
-            metadata_response = await get_metadata(mn, pid, session)
-            break  # no exception, so break out of the retry loop
-        except:
-            print('Exception: ', sys.exc_info()[0], flush=True)
-            retries += 1
-            print('retries:', retries, ' ', pid, '  getting metadata', flush=True)
-            if retries >= MAX_RETRIES:
-                print('Reached max retries getting metadata. Giving up...', flush=True)
-                return
-            time.sleep(1)
-    metadata_records[pid] = metadata_response
-
-
-async def run_get_metadata_tasks(mn: str, pids: List[str]):
+    try:
+        metadata_response = await source.get_metadata(pid, scheduler)
+    except:
+        print('Exception: ', sys.exc_info()[0], flush=True)
+        print('Gave up getting metadata for', pid, flush=True)
+        check_for_consistency(doi_records[pid], None)
+        return
+    doi_record = doi_records[pid]
+    metadata_records[pid] = obsolescence_values(metadata_response)
+    if check_for_consistency(doi_record, metadata_records[pid]) and verified:
+        metadata_fingerprint = fingerprint(metadata_response, doi_record.metadataObsoletesPID,
+                                           doi_record.metadataObsoletedByPID, verified)
+        if metadata_fingerprint:
+            metadata_fingerprints[pid] = metadata_fingerprint
+
+
+async def run_get_metadata_tasks(mn: str, pids: List[str], scheduler_settings: Scheduler_settings,
+                                 response_cache: ResponseCache, fingerprint_store: Fingerprint_store = None,
+                                 verified: str = None):
     """
-    Fire off a list of tasks to get metadata and save it in the metadata_records
-    table.
+    Get metadata for a list of pids, check it and save its obsolescence information
+    in the metadata_records table. Up to concurrency requests are kept in flight,
+    and the request rate is limited so we don't do a denial of service attack on
+    the node. If a fingerprint store is given, PIDs whose metadata hasn't changed
+    since it was verified are skipped, and the fingerprints of the metadata found
+    to be as expected are saved in the metadata_fingerprints table with the
+    verified time.
     """
-    async with ClientSession() as session:
-        tasks = [save_metadata(mn, pid, session) for pid in pids]
-        await asyncio.gather(*tasks)
+    count = 0
+    source = Sysmeta_source('MN', mn, 'mn')
+
+    async def get_and_count(pid: str):
+        nonlocal count
+        await save_metadata(source, pid, scheduler, verified if fingerprint_store else None)
+        count += 1
+        if count % 1000 == 0:   # Just so we can see signs of life...
+            print('count = {}, time = {}'.format(count, datetime.now().strftime("%H:%M:%S")), flush=True)
 
+    async with RequestScheduler(scheduler_settings, response_cache) as scheduler:
+        if fingerprint_store:
+            expected = {pid: (doi_records[pid].metadataObsoletesPID, doi_records[pid].metadataObsoletedByPID)
+                        for pid in pids}
+            unchanged = await unchanged_pids(mn, expected, fingerprint_store, scheduler)
+            print('{} PIDs unchanged since they were verified'.format(len(unchanged)), flush=True)
+            for pid in unchanged:
+                metadata_records[pid] = UNCHANGED
+            pids = [pid for pid in pids if pid not in unchanged]
+        await scheduler.run(get_and_count, pids)
+    print('count = {}, time = {}'.format(count, datetime.now().strftime("%H:%M:%S")), flush=True)
 
-def check_for_consistency(doi_record, metadata):
-    """ Check metadata xml for agreement with the DOI record. """
-    pid = doi_record.metadataPID
-    if not metadata:
-        print('Metadata not available for pid', pid, flush=True)
-        return
 
-    expect_obsoletes = doi_record.metadataObsoletesPID
-    expect_obsoletedBy = doi_record.metadataObsoletedByPID
-
-    root = ET.fromstring(metadata)
-    obsoletes_elements = root.findall('obsoletes')
-    if len(obsoletes_elements) > 0:
-        have_obsoletes = obsoletes_elements[0].text
-    else:
-        have_obsoletes = ''
-    obsoletedBy_elements = root.findall('obsoletedBy')
-    if len(obsoletedBy_elements) > 0:
-        have_obsoletedBy = obsoletedBy_elements[0].text
-    else:
-        have_obsoletedBy = ''
-
-    if expect_obsoletes != have_obsoletes or expect_obsoletedBy != have_obsoletedBy:
-        print(pid, flush=True)
-
-    if expect_obsoletes != have_obsoletes:
-        print('   Expected obsoletes={}'.format(ascii(expect_obsoletes)), flush=True)
-        print('   Found obsoletes   ={}'.format(ascii(have_obsoletes)), flush=True)
-        print('\n'.join(difflib.ndiff([expect_obsoletes], [have_obsoletes])))
-    if expect_obsoletedBy != have_obsoletedBy:
-        print('   Expected obsoletedBy={}'.format(ascii(expect_obsoletedBy)), flush=True)
-        print('   Found obsoletedBy   ={}'.format(ascii(have_obsoletedBy)), flush=True)
-        print('\n'.join(difflib.ndiff([expect_obsoletedBy], [have_obsoletedBy])))
-
-    if expect_obsoletes != have_obsoletes or expect_obsoletedBy != have_obsoletedBy:
+def check_for_consistency(doi_record, obsolescence: Tuple[str, str]):
+    """
+    Check the obsoletes and obsoletedBy values found in the metadata for
+    agreement with the DOI record. Returns True if they agree.
+    """
+    expected = (doi_record.metadataObsoletesPID, doi_record.metadataObsoletedByPID)
+    if check_consistency(doi_record.metadataPID, expected, obsolescence):
+        return True
+    if obsolescence is not None:
         print(flush=True)
+    return False
+
+
+def save_fingerprints(fingerprint_store: Fingerprint_store, consistent: List[str],
+                      inconsistent: List[str], verified: str):
+    """
+    Save the fingerprints of the metadata found to be as expected, and forget
+    those of the rest.
+    """
+    fingerprint_store.touch_many(
+        [pid for pid in consistent if metadata_records[pid] == UNCHANGED], verified)
+    fingerprint_store.save_many(metadata_fingerprints.items())
+    fingerprint_store.forget_many(inconsistent)
+
+
+def read_updated(updated_csv_file: str, obsolescence_chains_csv_file: str, neighbors: bool):
+    """
+    Load the DOI records of the updated PIDs into the doi_records table, along
+    with those of their neighbors in the obsolescence chains if neighbors is True.
+    """
+    updated = collections.OrderedDict(
+        (doi_record.metadataPID, doi_record) for doi_record in read_chains(updated_csv_file))
+    print('{} updated PIDs in {}'.format(len(updated), updated_csv_file), flush=True)
+    wanted = set(updated)
+    if neighbors:
+        for doi_record in updated.values():
+            wanted.update(pid for pid in (doi_record.metadataObsoletesPID, doi_record.metadataObsoletedByPID)
+                          if pid)
+    # Keep the order of the obsolescence chains CSV file
+    for doi_record in read_chains(obsolescence_chains_csv_file):
+        pid = doi_record.metadataPID
+        if pid in wanted:
+            doi_records[pid] = updated.get(pid, doi_record)
+            metadata_records[pid] = None
+    for pid, doi_record in updated.items():
+        if pid not in doi_records:
+            doi_records[pid] = doi_record
+            metadata_records[pid] = None
 
 
-def main(obsolescence_chains_csv_file: str, mn: str, max_n: int, deep: bool):
+def main(obsolescence_chains_csv_file: str, mn: str, max_n: int, deep: bool,
+         scheduler_settings: Scheduler_settings, cache: str, cache_ttl: float,
+         fingerprints: str = None, verify: str = None, neighbors: bool = False):
+    started = run_started()
 
     global doi_records
     global metadata_records
     global sent_count
 
     # Read in the DOI records
-    with open(obsolescence_chains_csv_file, 'r') as input_csv_file:
-        # Check for UNRESOLVED entries
-        if input_csv_file.read().find(UNRESOLVED) > -1:
-            print(
-                'UNRESOLVED DOIs found. Please run resolve_unresolved_dois.py '
-                'and use its output. Exiting.', flush=True
-            )
-            exit(0)
-
-        input_csv_file.seek(0)
-        csvreader = csv.reader(input_csv_file, delimiter=',')
-        # skip the header
-        next(csvreader)
-        for row in csvreader:
-            doi_record = DOI_record(*row)
-            if deep or doi_record.metadataObsoletesPID or doi_record.metadataObsoletedByPID:
-                pid = doi_record.metadataPID
-                doi_records[pid] = doi_record
-                # Initialize the metadata_records table, too, so we have rows in the same order. 
-                # This will make it easier to check and troubleshoot.
-                metadata_records[pid] = None
+    with stop_on_chains_file_error():
+        if verify:
+            read_updated(verify, obsolescence_chains_csv_file, neighbors)
+        else:
+            for doi_record in read_chains(obsolescence_chains_csv_file):
+                if deep or doi_record.metadataObsoletesPID or doi_record.metadataObsoletedByPID:
+                    pid = doi_record.metadataPID
+                    doi_records[pid] = doi_record
+                    # Initialize the metadata_records table, too, so we have rows in the same order. 
+                    # This will make it easier to check and troubleshoot.
+                    metadata_records[pid] = None
 
     print(len(doi_records), flush=True)
 
-    # Go get the metadata that needs to be modified
-    print('\nGetting metadata', flush=True)
-    count = 0
-    pids = []
-    for _, doi_record in doi_records.items():
-        pids.append(doi_record.metadataPID)
-        count += 1
-        # Access the member node in bursts so we don't do a denial of service attack on it
-        if count % BURST_SIZE == 0:
-            # Create tasks to get metadata
-            asyncio.run(run_get_metadata_tasks(mn, pids))
-            time.sleep(1)
-            pids = []
-        if count % 1000 == 0:   # Just so we can see signs of life...
-            print('count = {}, time = {}'.format(count, datetime.now().strftime("%H:%M:%S")), flush=True)
-    asyncio.run(run_get_metadata_tasks(mn, pids))
-    print('count = {}, time = {}'.format(count, datetime.now().strftime("%H:%M:%S")), flush=True)
-
-    # Now that we've got the metadata, check it against the expected values
-    print('\nChecking metadata', flush=True)
+    # Go get the metadata and check it against the expected values as it arrives
+    print('\nGetting and checking metadata', flush=True)
     print(flush=True)
+    pids = [doi_record.metadataPID for doi_record in doi_records.values()]
+    response_cache = ResponseCache(cache, cache_ttl) if cache else None
+    fingerprint_store = Fingerprint_store(fingerprints) if fingerprints else None
+    asyncio.run(run_get_metadata_tasks(mn, pids, scheduler_settings, response_cache, fingerprint_store,
+                                       started))
+    if response_cache:
+        response_cache.close()
 
     doi_pids = set()
     metadata_pids = set()
@@ -210,11 +239,30 @@ def main(obsolescence_chains_csv_file: str, mn: str, max_n: int, deep: bool):
         print(metadata_pids - doi_pids, flush=True)
         print(flush=True)
 
+    # The differences have been printed as the metadata arrived
+    consistent = []
+    inconsistent = []
+    unverified = []
     for doi, doi_record in doi_records.items():
         pid = doi_record.metadataPID
         if pid in metadata_records:
             metadata_record = metadata_records[pid]
-            check_for_consistency(doi_record, metadata_record)
+            if metadata_record == UNCHANGED or \
+                    metadata_record == (doi_record.metadataObsoletesPID, doi_record.metadataObsoletedByPID):
+                consistent.append(pid)
+            else:
+                inconsistent.append(pid)
+                if metadata_record is None:
+                    unverified.append(pid)
+    if unverified:
+        print('{} PIDs unverified, because their metadata could not be fetched:'.format(len(unverified)),
+              flush=True)
+        for pid in unverified:
+            print('   {}'.format(pid), flush=True)
+
+    if fingerprint_store:
+        save_fingerprints(fingerprint_store, consistent, inconsistent, started)
+        fingerprint_store.close()
 
 
 if __name__ == '__main__':
@@ -1,11 +1,12 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import csv
 from typing import List
 
 import click
 
+from chains_csv import read_chains, stop_on_chains_file_error
+
 
 @click.command()
 @click.argument('obsolescence_chain_csv_file')
@@ -51,16 +52,7 @@ def _sort_by_package_id(csv_row: List[str]):
 
 
 def _read_and_sort_obsolescence_chains_csv_file(chains_filename: str):
-    csv_rows = []
-    with open(chains_filename, 'r') as chains_file:
-        csvreader = csv.reader(chains_file, delimiter=',')
-        
-        # skip the header
-        next(csvreader)
-
-        csv_rows = [row for row in csvreader]
-
-    return sorted(csv_rows, key=lambda x: _sort_by_package_id(x))
+    return sorted(read_chains(chains_filename, resolved=False), key=_sort_by_package_id)
 
 
 def _rows_are_from_same_identifier(row_1: List[str], row_2: List[str]):
@@ -123,7 +115,8 @@ def check_consistency(sorted_rows: List[List[str]]):
 
 
 def main(obsolescence_chains_csv_file: str):
-    sorted_rows = _read_and_sort_obsolescence_chains_csv_file(obsolescence_chains_csv_file)
+    with stop_on_chains_file_error():
+        sorted_rows = _read_and_sort_obsolescence_chains_csv_file(obsolescence_chains_csv_file)
     check_consistency(sorted_rows)
 
 
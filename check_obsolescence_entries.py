@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import csv
+from datetime import datetime
+import sys
+from typing import List, Tuple
+
+import asyncio
+import click
+
+from chains_csv import read_chains, stop_on_chains_file_error
+from http_cache import ResponseCache, cache_options
+from obsolescence_sources import PASTA_source, Sysmeta_source, print_field_differences
+from request_scheduler import RequestScheduler, Scheduler_settings, scheduler_options
+
+
+SOURCES = ('mn', 'cn', 'pasta')
+# Stands in for the values of a source that couldn't be looked up
+UNAVAILABLE = 'UNAVAILABLE'
+
+
+@click.command()
+@click.argument("obsolescence_chains_csv_file")
+@click.argument("report_csv_file")
+@click.option(
+    "-m",
+    default="gmn.lternet.edu",
+    help="member node: e.g., gmn.lternet.edu, gmn.edirepository.org. "
+         "default: gmn.lternet.edu",
+)
+@click.option(
+    "-c",
+    default="cn.dataone.org",
+    help="coordinating node: e.g., cn.dataone.org (the default). "
+)
+@click.option(
+    "-s",
+    "--source",
+    multiple=True,
+    type=click.Choice(SOURCES),
+    help="source to check: mn, cn or pasta. May be given more than once. default: all three"
+)
+@click.option("-n", default=0, help="max number of checks to make")
+@click.option("--deep", default=False, is_flag=True, help="check all objects, "
+    "not just objects expected to have obsolescence information")
+@scheduler_options()
+@cache_options
+def check_obsolescence_entries(
+    obsolescence_chains_csv_file: str, report_csv_file: str, m: str, c: str, source: Tuple[str],
+    n: str, deep: bool, scheduler_settings: Scheduler_settings, cache: str, cache_ttl: float
+):
+    """
+    Check the obsolescence information on the member node, on the coordinating
+    node and in PASTA against the expected values based on the obsolescence
+    chains in ORE objects, in a single pass. The latter are read in from a CSV
+    file obtained by running get_obsolescence_chains.py and resolve_unresolved_dois.py.
+
+Arguments: \n
+        OBSOLESCENCE_CHAINS_CSV_FILE (input): obsolescence chains in the form of output from
+get_obsolescence_chains.py and resolve_unresolved_dois.py \n
+        REPORT_CSV_FILE (output): the expected and found obsoletes and obsoletedBy values
+        of each PID checked
+
+        The sources of each PID are looked up concurrently, and the PIDs are read
+        from OBSOLESCENCE_CHAINS_CSV_FILE as they are checked. The member node and
+        the coordinating node are checked from the PID's system metadata. For PASTA,
+        the values are the PIDs of the revisions before and after the PID's in the
+        package's list of revisions.
+
+        The report has a row per PID, in the order the checks finish. Columns are: \n
+            pid, expectedObsoletes, expectedObsoletedBy, and for each source checked,
+            e.g., mnObsoletes, mnObsoletedBy, then mismatches, the sources whose values
+            differ from the expected ones. The values of a source that couldn't be
+            looked up are UNAVAILABLE.
+    """
+
+    # Check the Python version
+    if sys.version_info < (3, 7):
+        print("Requires Python 3.7 or later")
+        exit(0)
+
+    main(obsolescence_chains_csv_file, report_csv_file, m, c, source or SOURCES, int(n), deep,
+         scheduler_settings, cache, cache_ttl)
+
+
+def make_sources(names: Tuple[str], mn: str, cn: str) -> List:
+    sources = []
+    for name in SOURCES:
+        if name not in names:
+            continue
+        if name == 'mn':
+            sources.append(Sysmeta_source('MN', mn, 'mn'))
+        elif name == 'cn':
+            sources.append(Sysmeta_source('CN', cn, 'cn'))
+        else:
+            sources.append(PASTA_source())
+    return sources
+
+
+async def lookup(source, pid: str, scheduler: RequestScheduler) -> Tuple[str, str]:
+    """ The source's (obsoletes, obsoletedBy) values for the PID, or None if they're not available. """
+    try:
+        return await source.lookup(pid, scheduler)
+    except:
+        print('Exception: ', sys.exc_info()[0], flush=True)
+        print('Gave up getting {} obsolescence information for {}'.format(source.name, pid), flush=True)
+        return None
+
+
+def report_differences(pid: str, expected: Tuple[str, str], sources: List, found: List[Tuple[str, str]]):
+    """ Print the values found that differ from the expected ones. """
+    print(pid, flush=True)
+    for source, values in zip(sources, found):
+        if values is None:
+            print('   {} not available'.format(source.name), flush=True)
+            continue
+        print_field_differences(expected, values, source.name)
+    print(flush=True)
+
+
+async def run_check_tasks(doi_records, sources: List, scheduler_settings: Scheduler_settings,
+                          response_cache: ResponseCache, report_writer) -> List[int]:
+    """
+    Check each DOI record against the sources, looking up a PID's sources
+    concurrently. Up to concurrency requests are kept in flight, and the request
+    rate is limited so we don't do a denial of service attack on the nodes.
+    Returns the number of PIDs found to differ in each source.
+    """
+    count = 0
+    errors = [0] * len(sources)
+
+    async def check_and_count(doi_record):
+        nonlocal count
+        pid = doi_record.metadataPID
+        expected = (doi_record.metadataObsoletesPID, doi_record.metadataObsoletedByPID)
+        found = await asyncio.gather(*[lookup(source, pid, scheduler) for source in sources])
+        mismatches = []
+        row = [pid, *expected]
+        for i, (source, values) in enumerate(zip(sources, found)):
+            row.extend(values or (UNAVAILABLE, UNAVAILABLE))
+            if values != expected:
+                mismatches.append(source.name)
+                errors[i] += 1
+        report_writer.writerow(row + [' '.join(mismatches)])
+        if mismatches:
+            report_differences(pid, expected, sources, found)
+        count += 1
+        if count % 1000 == 0:   # Just so we can see signs of life...
+            print('count = {}, time = {}'.format(count, datetime.now().strftime("%H:%M:%S")), flush=True)
+
+    async with RequestScheduler(scheduler_settings, response_cache) as scheduler:
+        await scheduler.run(check_and_count, doi_records)
+    print('count = {}, time = {}'.format(count, datetime.now().strftime("%H:%M:%S")), flush=True)
+    return errors
+
+
+def records_to_check(obsolescence_chains_csv_file: str, max_n: int, deep: bool):
+    """ The DOI records to check, read from the obsolescence chains CSV file. """
+    count = 0
+    for doi_record in read_chains(obsolescence_chains_csv_file):
+        if max_n > 0 and count >= max_n:
+            return
+        if deep or doi_record.metadataObsoletesPID or doi_record.metadataObsoletedByPID:
+            count += 1
+            yield doi_record
+
+
+def main(obsolescence_chains_csv_file: str, report_csv_file: str, mn: str, cn: str, source_names: Tuple[str],
+         max_n: int, deep: bool, scheduler_settings: Scheduler_settings, cache: str, cache_ttl: float):
+    # Read the records before any checks, so a file that can't be used stops the run up front
+    with stop_on_chains_file_error():
+        doi_records = list(records_to_check(obsolescence_chains_csv_file, max_n, deep))
+
+    sources = make_sources(source_names, mn, cn)
+    print('Checking {}'.format(', '.join(source.name for source in sources)), flush=True)
+
+    columns = ['pid', 'expectedObsoletes', 'expectedObsoletedBy']
+    for name in SOURCES:
+        if name in source_names:
+            columns.extend([name + 'Obsoletes', name + 'ObsoletedBy'])
+    columns.append('mismatches')
+
+    response_cache = ResponseCache(cache, cache_ttl) if cache else None
+    try:
+        with open(report_csv_file, mode='w', newline='') as report_csv:
+            report_writer = csv.writer(report_csv, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+            report_writer.writerow(columns)
+            errors = asyncio.run(run_check_tasks(
+                doi_records, sources, scheduler_settings, response_cache, report_writer))
+    finally:
+        if response_cache:
+            response_cache.close()
+
+    print(flush=True)
+    for source, error_count in zip(sources, errors):
+        print('{}: {} errors found'.format(source.name, error_count), flush=True)
+
+
+if __name__ == '__main__':
+    print(datetime.now().strftime('%H:%M:%S'), flush=True)
+    try:
+        check_obsolescence_entries()
+    finally:
+        # click exits via sys.exit(), so we use try/finally to get the
+        # ending datetime to display
+        print(datetime.now().strftime('%H:%M:%S'), flush=True)
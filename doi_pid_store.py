@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Persistent store of DOI to metadata PID mappings, shared by the scripts so
+that each batch can resolve DOIs learned by earlier batches without querying
+doi.org or maintaining a mapping file.
+
+get_obsolescence_chains.py saves the metadata PID of every ORE object it
+reads, and resolve_unresolved_dois.py looks DOIs up in the store before
+resolving them over the network, saving what it resolves. The mappings are
+kept in a SQLite database keyed by DOI, so lookups don't load the whole
+store.
+"""
+
+import sqlite3
+from typing import Dict, Iterable, Tuple
+
+import click
+
+
+DEFAULT_STORE = 'doi_to_pid.sqlite'
+# SQLite limits the number of parameters in a query
+LOOKUP_BATCH = 500
+
+
+def doi_store_option(f):
+    """
+    Decorator adding the --doi-store option to a click command.
+    The command function receives it as the `doi_store` argument.
+    """
+    return click.option(
+        "--doi-store",
+        default=DEFAULT_STORE,
+        help="SQLite file of the DOI to PID mappings learned so far, shared by the scripts. "
+             "default: {}".format(DEFAULT_STORE)
+    )(f)
+
+
+class DOI_PID_store:
+    """ DOI to metadata PID mappings keyed by DOI. """
+
+    def __init__(self, path: str = DEFAULT_STORE):
+        self.connection = sqlite3.connect(path, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS doi_pid (doi TEXT PRIMARY KEY, pid TEXT)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS doi_pid_pid ON doi_pid (pid)')
+
+    def close(self):
+        self.connection.close()
+
+    def lookup(self, doi: str) -> str:
+        """ Returns the PID for the DOI, or None. """
+        row = self.connection.execute('SELECT pid FROM doi_pid WHERE doi = ?', (doi,)).fetchone()
+        return row[0] if row else None
+
+    def lookup_many(self, dois: Iterable[str]) -> Dict[str, str]:
+        """ Returns the PIDs for those of the DOIs that are in the store. """
+        return self.select_many('SELECT doi, pid FROM doi_pid WHERE doi IN ({})', dois)
+
+    def lookup_dois(self, pids: Iterable[str]) -> Dict[str, str]:
+        """ Returns the DOIs for those of the PIDs that are in the store, keyed by PID. """
+        return self.select_many('SELECT pid, doi FROM doi_pid WHERE pid IN ({})', pids)
+
+    def select_many(self, query: str, keys: Iterable[str]) -> Dict[str, str]:
+        keys = list(keys)
+        values = {}
+        for start in range(0, len(keys), LOOKUP_BATCH):
+            batch = keys[start:start + LOOKUP_BATCH]
+            values.update(self.connection.execute(query.format(','.join('?' * len(batch))), batch))
+        return values
+
+    def save(self, doi: str, pid: str):
+        self.connection.execute('INSERT OR REPLACE INTO doi_pid VALUES (?, ?)', (doi, pid))
+
+    def save_many(self, mappings: Iterable[Tuple[str, str]]):
+        """ Save (DOI, PID) pairs in a single transaction. """
+        with self.connection:
+            self.connection.execute('BEGIN')
+            self.connection.executemany('INSERT OR REPLACE INTO doi_pid VALUES (?, ?)', mappings)
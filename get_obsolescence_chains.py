@@ -4,21 +4,27 @@
 import asyncio
 import collections
 import csv
-from datetime import datetime
+from datetime import datetime, timedelta
+import os
 import sys
-import time
-from typing import List
+from typing import AsyncIterator, Dict, Iterable, List, Set, Tuple
 
-from aiohttp import ClientSession
 import click
 from namedlist import namedlist
-import xml.etree.ElementTree as ET
+
+from chains_csv import read_chains, stop_on_chains_file_error
+from doi_pid_store import DOI_PID_store, doi_store_option
+from http_cache import ResponseCache, cache_options
+from list_ore_dois import DOI_PREFIX, stream_ore_dois
+from request_scheduler import RequestScheduler, Scheduler_settings, scheduler_options
+from sysmeta_fields import extract_fields
 
 
 TRACE = False
 UNRESOLVED = 'UNRESOLVED'
-MAX_RETRIES = 3
-BURST_SIZE = 10
+METADATA_PID_PREFIX = 'https://pasta.lternet.edu/package/metadata/eml/'
+CHUNK_SIZE = 16384
+LIST_OBJECTS = 'listObjects'
 
 doi_records = collections.OrderedDict()
 
@@ -32,20 +38,49 @@ DOI_record = namedlist(
 @click.option('-m', 
     default='gmn.lternet.edu', 
     help='member node: e.g., gmn.lternet.edu, gmn.edirepository.org. default: gmn.lternet.edu')
+@scheduler_options()
+@cache_options
+@doi_store_option
+@click.option('--resume', default=False, is_flag=True, 
+    help='resume an interrupted run, fetching only the DOIs not in its journal file')
+@click.option('--since', default=None,
+    help='process only ORE objects modified since this date-time, e.g., 2019-04-01T00:00:00.000+00:00, '
+         'and merge the results into the existing OUTPUT_CSV_FILE')
+@click.option('--incremental', default=False, is_flag=True,
+    help='like --since, using the time the last run on OUTPUT_CSV_FILE started')
+@click.option('--changes', default=None,
+    help='with --since or --incremental, CSV file in which to save just the records that changed')
 @click.argument('doi_file')
 @click.argument('output_csv_file')
-def get_obsolescence_chains(m: str, doi_file: str, output_csv_file: str):
+def get_obsolescence_chains(m: str, scheduler_settings: Scheduler_settings, cache: str, 
+                            cache_ttl: float, doi_store: str, resume: bool, since: str, 
+                            incremental: bool, changes: str, doi_file: str, output_csv_file: str):
     """
     Generates a CSV file containing the obsolescence chains for DOIs associated with a DataONE Generic Member Node. 
 
 Arguments: \n
-        DOI_FILE: text file containing a list of DOIs, one per line \n
+        DOI_FILE: text file containing a list of DOIs, one per line, or listObjects to get the
+        DOIs of the ORE objects on the member node from its listObjects API \n
         OUTPUT_CSV_FILE: the CSV file to be generated 
 
         The output CSV file will have a header row. Columns are:  \n
             doi, obsoletes, obsoletedBy, metadataPID, metadataPIDObsoletes, metadataPIDObsoletedBy
 
         If metadata is not available for a DOI, the corresponding metadata PID entries will be UNRESOLVED
+
+        As DOIs are processed, their records are appended to a journal file, OUTPUT_CSV_FILE.journal,
+        which is removed when the output CSV file has been written. If a run is interrupted, rerun it
+        with --resume to process only the DOIs that are not in the journal.
+
+        The time each run starts is saved in OUTPUT_CSV_FILE.timestamp. With --incremental, only the
+        ORE objects whose system metadata has been modified since the last run, and their neighbors
+        in the obsolescence chains, are processed. Their records are merged into OUTPUT_CSV_FILE.
+        If DOI_FILE is a file, only the DOIs in it are considered. With --changes, the records of
+        the changed DOIs, and of the neighbors whose records came out different, are saved in
+        a separate CSV file as well.
+
+        The metadata PID found for each DOI is saved in the DOI to PID store, where
+        resolve_unresolved_dois.py looks for it.
     """
 
     # Check the Python version
@@ -53,56 +88,79 @@ Arguments: \n
         print('Requires Python 3.7 or later')
         exit(0)
 
-    main(m, doi_file, output_csv_file)
+    main(m, doi_file, output_csv_file, scheduler_settings, cache, cache_ttl, doi_store, resume, since, 
+         incremental, changes)
 
 
-async def get_ORE_metadata(mn: str, doi: str, session: ClientSession, **kwargs) -> str:
+async def get_ORE_metadata(mn: str, doi: str, scheduler: RequestScheduler, **kwargs) -> str:
     metadata_url = 'https://{}/mn/v2/meta/{}'.format(mn, doi)
-    resp = await session.request(method='GET', url=metadata_url, **kwargs)
-    resp.raise_for_status()
-    return await resp.text()
+    return await scheduler.get_text(metadata_url, **kwargs)
 
 
-async def get_ORE_object(mn: str, doi: str, session: ClientSession, **kwargs) -> str:
+async def scan_ORE_object(mn: str, doi: str, scheduler: RequestScheduler, **kwargs) -> List[str]:
+    """
+    Scan the ORE object for lines containing the metadata PID, and return them.
+    More than one line means the object has duplicates, so the scan stops at the
+    second one, and the rest of the object isn't downloaded. Otherwise the whole
+    object is scanned, since a duplicate could come anywhere in it. The object is
+    streamed from the member node and scanned a chunk at a time, so it is never
+    held in memory as a whole.
+    """
     object_url = 'https://{}/mn/v2/object/{}'.format(mn, doi)
-    resp = await session.request(method='GET', url=object_url, **kwargs)
-    resp.raise_for_status()
-    return await resp.text()
-
-
-async def parse_ORE_metadata(mn: str, doi: str, session: ClientSession):
+    if scheduler.cache is not None:
+        # Go through the cache, which needs the whole object
+        object_response = await scheduler.get_text(object_url, **kwargs)
+        return [line for line in object_response.split('\n') if METADATA_PID_PREFIX in line][:2]
+
+    prefix = METADATA_PID_PREFIX.encode('utf-8')
+
+    async def scan():
+        # Leaving the block releases the response, closing the connection if the
+        # body wasn't read to the end, so no more of it is downloaded
+        async with scheduler.request('GET', object_url, **kwargs) as resp:
+            resp.raise_for_status()
+            matched_lines = []
+            pending = b''
+            async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+                lines = (pending + chunk).split(b'\n')
+                # The last line may continue in the next chunk
+                pending = lines.pop()
+                matched_lines.extend(line for line in lines if prefix in line)
+                if len(matched_lines) > 1:
+                    # A second metadata PID proves there are duplicates
+                    return [line.decode('utf-8') for line in matched_lines[:2]]
+            if prefix in pending:
+                matched_lines.append(pending)
+            return [line.decode('utf-8') for line in matched_lines]
+
+    return await scheduler.retry(scan, 'getting ORE object ' + doi)
+
+
+async def parse_ORE_metadata(mn: str, doi: str, scheduler: RequestScheduler):
     global doi_records
-    retries = 0
-    while retries < MAX_RETRIES:
-        try:
-            metadata_response = await get_ORE_metadata(mn, doi, session)
-            break  # no exception, so get out of the retry loop
-        except:
-            print('Exception: ', sys.exc_info()[0], flush=True)
-            retries += 1
-            print('retries:', retries, ' ', doi, '  getting ORE metadata', flush=True)
-            if retries >= MAX_RETRIES:
-                print('Reached max retries getting ORE metadata. Giving up...', flush=True)
-                return
-            time.sleep(1)
+    try:
+        metadata_response = await get_ORE_metadata(mn, doi, scheduler)
+    except:
+        print('Exception: ', sys.exc_info()[0], flush=True)
+        print('Gave up getting ORE metadata for', doi, flush=True)
+        return False
 
     obsoletes = None
     obsoletedBy = None
     metadataObsoletesPID = None
     metadataObsoletedByPID = None
 
-    root = ET.fromstring(metadata_response)
-    for child in root:
-        if child.tag == 'obsoletes':
-            obsoletes = child.text
-            metadataObsoletesPID = UNRESOLVED
-            if TRACE:
-                print('{} obsoletes {}'.format(obsoletes, doi))
-        elif child.tag == 'obsoletedBy':
-            obsoletedBy = child.text
-            metadataObsoletedByPID = UNRESOLVED
-            if TRACE:
-                print('{} obsoletedBy {}'.format(obsoletedBy, doi))
+    fields = extract_fields(metadata_response)
+    if fields.obsoletes is not None:
+        obsoletes = fields.obsoletes
+        metadataObsoletesPID = UNRESOLVED
+        if TRACE:
+            print('{} obsoletes {}'.format(obsoletes, doi))
+    if fields.obsoletedBy is not None:
+        obsoletedBy = fields.obsoletedBy
+        metadataObsoletedByPID = UNRESOLVED
+        if TRACE:
+            print('{} obsoletedBy {}'.format(obsoletedBy, doi))
     if doi not in doi_records:
         print('Unexpected Error - parse_ORE_metadata finds doi not in dictionary: ', doi, flush=True)
         doi_records[doi] = DOI_record(doi, obsoletes, obsoletedBy, UNRESOLVED, None, None)
@@ -110,81 +168,236 @@ async def parse_ORE_metadata(mn: str, doi: str, session: ClientSession):
     doi_records[doi].obsoletedBy = obsoletedBy        
     doi_records[doi].metadataObsoletesPID = metadataObsoletesPID
     doi_records[doi].metadataObsoletedByPID = metadataObsoletedByPID
+    return True
 
 
-async def parse_ORE_object(mn: str, doi: str, session: ClientSession):
+async def parse_ORE_object(mn: str, doi: str, scheduler: RequestScheduler):
     global doi_records
 
-    retries = 0
-    while retries < MAX_RETRIES:
-        try:
-            object_response = await get_ORE_object(mn, doi, session)
-            break  # no exception, so get out of the retry loop
-        except:
-            print('Exception: ', sys.exc_info()[0], flush=True)
-            retries += 1
-            print('retries:', retries, ' ', doi, '  getting ORE object', flush=True)
-            if retries >= MAX_RETRIES:
-                print('Reached max retries getting ORE object. Giving up...', flush=True)
-                return
-            time.sleep(1)    
+    try:
+        matched_lines = await scan_ORE_object(mn, doi, scheduler)
+    except:
+        print('Exception: ', sys.exc_info()[0], flush=True)
+        print('Gave up getting ORE object for', doi, flush=True)
+        return False
 
     metadataPID = None
-    matched_lines = [line for line in object_response.split('\n') 
-        if "https://pasta.lternet.edu/package/metadata/eml/" in line]
     if len(matched_lines) == 0:
         print('metadataPID not found for {}'.format(doi), flush=True)
-        return
+        return True
     if len(matched_lines) > 1:
         print('Multiple metadataPIDs found for {}'.format(doi), flush=True)
-        return
+        return True
     metadataPID = matched_lines[0].strip().replace(
         '<dcterms:identifier>', '').replace('</dcterms:identifier>', '')
     if doi in doi_records:  
         doi_records[doi].metadataPID = metadataPID
+    return True
 
 
-async def run_ORE_metadata_tasks(mn: str, dois: List[str]):
-    async with ClientSession() as session:
-        tasks = [parse_ORE_metadata(mn, doi, session) for doi in dois]
-        await asyncio.gather(*tasks)
-
-
-async def run_ORE_object_tasks(mn: str, dois: List[str]):
-    async with ClientSession() as session:
-        tasks = [parse_ORE_object(mn, doi, session) for doi in dois]
-        await asyncio.gather(*tasks)
-
-
-def process_doi_file(mn: str, doi_filename: str):
-    count = 0
-    dois = []
+async def read_doi_file(doi_filename: str) -> AsyncIterator[str]:
     with open(doi_filename, mode='r') as doi_file:
         for doi in doi_file:
             doi = doi.strip()
             if not doi:
                 continue
-            dois.append(doi)
-            # Create a record for the doi so we'll have a row for it even if http fails
-            if doi not in doi_records:
-                doi_records[doi] = DOI_record(doi, None, None, UNRESOLVED, None, None)
-            else:
-                print('Unexpected Error - attempted to add a doi that was already in the dict: ', 
-                      doi, flush=True)
-            count += 1
-            # Access the member node in bursts so we don't do a denial of service attack on it
-            if count % BURST_SIZE == 0:
-                asyncio.run(run_ORE_metadata_tasks(mn, dois))
-                time.sleep(1)
-                asyncio.run(run_ORE_object_tasks(mn, dois))
-                time.sleep(1)
-                dois = []
-            if count % 100 == 0:   # Just so we can see signs of life...
-                print('count = {}, time = {}'.format(count, datetime.now().strftime("%H:%M:%S")), flush=True)
-    # Pick up the leftover dois, if any
-    asyncio.run(run_ORE_metadata_tasks(mn, dois))
-    asyncio.run(run_ORE_object_tasks(mn, dois))
+            yield doi
+
+
+async def iterate(items: Iterable[str]) -> AsyncIterator[str]:
+    for item in items:
+        yield item
+
+
+async def changed_dois(dois: AsyncIterator[str], changed: Set[str]) -> AsyncIterator[str]:
+    """ Yield the DOIs that have changed or that aren't in the previous chains. """
+    async for doi in dois:
+        if doi in changed or doi not in doi_records:
+            yield doi
+
+
+async def dois_to_process(dois: AsyncIterator[str], journaled: Dict[str, List], 
+                          previous: Set[str], processed: Set[str], 
+                          neighbors: Set[str]) -> AsyncIterator[str]:
+    """
+    Create records for the DOIs as they arrive, and yield the ones that
+    weren't already processed by an interrupted run. DOIs from previous
+    chains keep their records, which are updated when they are processed.
+    Their neighbors in the previous chains are added to neighbors.
+    """
+    async for doi in dois:
+        if doi in processed:
+            continue
+        # Create a record for the doi so we'll have a row for it even if http fails
+        if doi not in doi_records:
+            doi_records[doi] = DOI_record(doi, None, None, UNRESOLVED, None, None)
+        elif doi in previous:
+            doi_record = doi_records[doi]
+            neighbors.update(neighbor for neighbor in (doi_record.obsoletes, doi_record.obsoletedBy) 
+                             if neighbor)
+        else:
+            print('Unexpected Error - attempted to add a doi that was already in the dict: ', 
+                  doi, flush=True)
+            continue
+        processed.add(doi)
+        if doi in journaled:
+            doi_records[doi] = journaled[doi]
+            continue
+        yield doi
+
+
+def journal_filename(csv_filename: str) -> str:
+    return csv_filename + '.journal'
+
+
+def read_journal(journal_filename: str) -> Dict[str, List]:
+    """
+    Load the DOI records saved by an interrupted run. Returns a dict of the
+    records, keyed by DOI. These DOIs don't need to be processed again.
+    """
+    journaled = {}
+    if not os.path.exists(journal_filename):
+        return journaled
+    with open(journal_filename, mode='r', newline='') as journal_file:
+        for row in csv.reader(journal_file):
+            # The last row may be incomplete if the run was killed while writing it
+            if len(row) != len(DOI_record._fields):
+                continue
+            doi_record = DOI_record(*[value or None for value in row])
+            journaled[doi_record.doi] = doi_record
+    print('{} DOIs found in {}'.format(len(journaled), journal_filename), flush=True)
+    return journaled
+
+
+async def process_doi(mn: str, doi: str, scheduler: RequestScheduler) -> bool:
+    """
+    Get the ORE metadata and the ORE object for a DOI concurrently. When this
+    returns, the DOI's record is complete. Returns False if either request failed.
+    """
+    results = await asyncio.gather(
+        parse_ORE_metadata(mn, doi, scheduler),
+        parse_ORE_object(mn, doi, scheduler))
+    return all(results)
+
+
+async def run_ORE_tasks(mn: str, doi_filename: str, journaled: Dict[str, List], since: str,
+                        scheduler_settings: Scheduler_settings, response_cache: ResponseCache, 
+                        journal_writer) -> Tuple[Set[str], Set[str]]:
+    """
+    Process the DOIs, keeping up to concurrency requests in flight and limiting
+    the request rate so we don't do a denial of service attack on the member node.
+    If the DOIs are listed by the member node, they are processed as the pages
+    of the list arrive.
+
+    If since is given, only the DOIs whose ORE objects have changed since then
+    are processed, followed by their neighbors in the obsolescence chains.
+
+    Returns the set of DOIs processed, and the set of those processed only as
+    neighbors of changed DOIs.
+    """
+    count = 0
+    previous = set(doi_records)
+    processed = set()
+    neighbors = set()
+    neighbor_dois = set()
+
+    async def process_and_count(doi: str):
+        nonlocal count
+        if await process_doi(mn, doi, scheduler):
+            # Save the finished record so it survives an interrupted run
+            journal_writer.writerow(list(doi_records[doi]))
+        doi_record = doi_records[doi]
+        neighbors.update(neighbor for neighbor in (doi_record.obsoletes, doi_record.obsoletedBy) 
+                         if neighbor)
+        count += 1
+        if count % 100 == 0:   # Just so we can see signs of life...
+            print('count = {}, time = {}'.format(count, datetime.now().strftime("%H:%M:%S")), flush=True)
+
+    # Each DOI has two requests in flight
+    dois_in_flight = max(1, scheduler_settings.concurrency // 2)
+    async with RequestScheduler(scheduler_settings, response_cache) as scheduler:
+        if doi_filename == LIST_OBJECTS:
+            dois = stream_ore_dois(mn, scheduler, DOI_PREFIX, since)
+        else:
+            dois = read_doi_file(doi_filename)
+            if since:
+                changed = set([doi async for doi in stream_ore_dois(mn, scheduler, DOI_PREFIX, since)])
+                print('{} ORE objects changed since {}'.format(len(changed), since), flush=True)
+                dois = changed_dois(dois, changed)
+        await scheduler.run(
+            process_and_count, dois_to_process(dois, journaled, previous, processed, neighbors),
+            dois_in_flight)
+        if since:
+            # The records of the neighbors of changed DOIs may have changed, too
+            neighbors -= processed
+            print('{} neighbors of changed DOIs'.format(len(neighbors)), flush=True)
+            neighbor_dois = set(neighbors)
+            await scheduler.run(
+                process_and_count, 
+                dois_to_process(iterate(sorted(neighbors)), journaled, previous, processed, set()),
+                dois_in_flight)
     print('count = {}, time = {}'.format(count, datetime.now().strftime("%H:%M:%S")), flush=True)
+    return processed, neighbor_dois
+
+
+class Journal_writer:
+    """ Appends rows to the journal file, flushing each one. """
+
+    def __init__(self, journal_file):
+        self.journal_file = journal_file
+        self.csv_writer = csv.writer(journal_file)
+
+    def writerow(self, row):
+        self.csv_writer.writerow(row)
+        self.journal_file.flush()
+
+
+def process_doi_file(mn: str, doi_filename: str, scheduler_settings: Scheduler_settings,
+                     cache: str, cache_ttl: float, journal_filename: str, resume: bool,
+                     since: str) -> Tuple[Set[str], Set[str]]:
+    journaled = read_journal(journal_filename) if resume else {}
+    response_cache = ResponseCache(cache, cache_ttl) if cache else None
+    try:
+        with open(journal_filename, mode='a' if resume else 'w', newline='') as journal_file:
+            return asyncio.run(run_ORE_tasks(mn, doi_filename, journaled, since, scheduler_settings, 
+                                             response_cache, Journal_writer(journal_file)))
+    finally:
+        if response_cache:
+            response_cache.close()
+
+
+def timestamp_filename(csv_filename: str) -> str:
+    return csv_filename + '.timestamp'
+
+
+def read_timestamp(csv_filename: str) -> str:
+    """ The time the last run on the CSV file started, or None. """
+    filename = timestamp_filename(csv_filename)
+    if not os.path.exists(filename):
+        return None
+    with open(filename, mode='r') as timestamp_file:
+        return timestamp_file.read().strip()
+
+
+def save_timestamp(csv_filename: str, timestamp: str):
+    with open(timestamp_filename(csv_filename), mode='w') as timestamp_file:
+        timestamp_file.write('{}\n'.format(timestamp))
+
+
+def read_previous_chains(csv_filename: str):
+    """ Load the records from a previous run into the doi_records table. """
+    for row in read_chains(csv_filename, resolved=False):
+        doi_record = DOI_record(*[value or None for value in row])
+        doi_records[doi_record.doi] = doi_record
+    print('{} DOIs found in {}'.format(len(doi_records), csv_filename), flush=True)
+
+
+def save_to_doi_store(doi_store: str, dois: Set[str]):
+    """ Save the DOI to metadata PID mappings learned in this run. """
+    store = DOI_PID_store(doi_store)
+    store.save_many((doi, doi_records[doi].metadataPID) for doi in dois
+                    if doi_records[doi].metadataPID not in (None, UNRESOLVED))
+    store.close()
 
 
 def resolve_metadataPIDs():
@@ -206,7 +419,7 @@ def resolve_metadataPIDs():
             print('doi not found: {}'.format(doi), flush=True)
 
 
-def save_to_csv(csv_filename: str):
+def save_to_csv(csv_filename: str, dois: Set[str] = None):
     columns = [
         'doi', 
         'obsoletes', 
@@ -222,13 +435,41 @@ def save_to_csv(csv_filename: str):
             quoting=csv.QUOTE_MINIMAL)
         csv_writer.writerow(columns)
         for doi, doi_record in doi_records.items():
-            csv_writer.writerow(list(doi_record))
-
-
-def main(mn: str, doi_filename: str, csv_filename: str):
-    process_doi_file(mn, doi_filename)
+            if dois is None or doi in dois:
+                csv_writer.writerow(list(doi_record))
+
+
+def main(mn: str, doi_filename: str, csv_filename: str, scheduler_settings: Scheduler_settings,
+         cache: str, cache_ttl: float, doi_store: str, resume: bool, since: str, incremental: bool,
+         changes_filename: str):
+    # Allow a minute of slack for the member node's clock
+    started = (datetime.utcnow() - timedelta(minutes=1)).strftime('%Y-%m-%dT%H:%M:%S.000+00:00')
+    if incremental and not since:
+        since = read_timestamp(csv_filename)
+        if not since:
+            print('No previous run found for {}. Run without --incremental first.'.format(csv_filename), 
+                  flush=True)
+            exit(1)
+    previous_rows = {}
+    if since:
+        with stop_on_chains_file_error():
+            read_previous_chains(csv_filename)
+        previous_rows = {doi: tuple(doi_record) for doi, doi_record in doi_records.items()}
+    journal = journal_filename(csv_filename)
+    processed, neighbors = process_doi_file(mn, doi_filename, scheduler_settings, cache, cache_ttl, 
+                                            journal, resume, since)
+    save_to_doi_store(doi_store, processed)
     resolve_metadataPIDs()
     save_to_csv(csv_filename)
+    if changes_filename:
+        # Neighbors whose records came out the same would only be updated again for nothing
+        changes = set(doi for doi in processed
+                      if doi not in neighbors or tuple(doi_records[doi]) != previous_rows.get(doi))
+        print('{} changed records saved in {}'.format(len(changes), changes_filename), flush=True)
+        save_to_csv(changes_filename, changes)
+    save_timestamp(csv_filename, started)
+    # The output is complete, so the journal is no longer needed
+    os.remove(journal)
 
 
 if __name__ == '__main__':
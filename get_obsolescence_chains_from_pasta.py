@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import collections
+import csv
+from datetime import datetime
+import sys
+from typing import List
+import urllib.parse
+
+import click
+
+from chains_csv import COLUMNS, Chain_record
+from doi_pid_store import DOI_PID_store, doi_store_option
+from http_cache import ResponseCache, cache_options
+from obsolescence_sources import METADATA_PID_PREFIX, PASTA_DOMAIN, PASTA_source
+from request_scheduler import RequestScheduler, Scheduler_settings, scheduler_options
+
+
+doi_records = collections.OrderedDict()
+
+# Gets the packages' lists of revisions
+pasta = PASTA_source(PASTA_DOMAIN)
+
+# Each package's records, in revision order, keyed by package in input order
+package_records = collections.OrderedDict()
+
+
+@click.command()
+@click.option(
+    "-m",
+    default=None,
+    help="member node, e.g., gmn.lternet.edu. If given, revisions not on the member node are "
+         "left out of the chains. default: none"
+)
+@scheduler_options()
+@cache_options
+@doi_store_option
+@click.argument('package_file')
+@click.argument('output_csv_file')
+def get_obsolescence_chains_from_pasta(m: str, scheduler_settings: Scheduler_settings, cache: str,
+                                       cache_ttl: float, doi_store: str, package_file: str,
+                                       output_csv_file: str):
+    """
+    Generates a CSV file containing the expected obsolescence chains for data packages, like the
+    one get_obsolescence_chains.py generates, but from PASTA's lists of package revisions rather
+    than from the ORE objects on a member node. One request per package gets all its revisions.
+
+Arguments: \n
+        PACKAGE_FILE: text file listing the packages, one per line, as scope/identifier,
+        scope.identifier, or a metadata PID. A line with just a scope stands for all of the
+        scope's packages. \n
+        OUTPUT_CSV_FILE: the CSV file to be generated
+
+        The output CSV file will have a header row. Columns are:  \n
+            doi, obsoletes, obsoletedBy, metadataPID, metadataPIDObsoletes, metadataPIDObsoletedBy
+
+        The DOIs of the revisions are looked up in the DOI to PID store. Those not found there are
+        requested from PASTA, one request per revision, and saved in the store. So a package takes
+        one request once its revisions' DOIs are in the store, and one more per revision before.
+
+        PASTA lists every revision of a package, which may include revisions that are not on
+        the member node. With -m, each revision is looked for on the member node with a describe
+        (HEAD) request, and those not found are left out. Revisions left out, or whose DOIs can't
+        be found, are skipped over in the chains: each record is linked to the nearest revisions
+        before and after it that are kept.
+    """
+
+    # Check the Python version
+    if (sys.version_info < (3, 7)):
+        print('Requires Python 3.7 or later')
+        exit(0)
+
+    main(package_file, output_csv_file, scheduler_settings, cache, cache_ttl, doi_store, m)
+
+
+def package_key(line: str) -> str:
+    """ 'scope/identifier' for a line of the package file, or 'scope' for a scope. """
+    package = line.strip().replace(METADATA_PID_PREFIX, '')
+    if '/' in package:
+        parts = package.split('/')
+    else:
+        parts = package.split('.')
+    if len(parts) > 2:
+        # A PID, or a package ID with a revision
+        parts = parts[:2]
+    return '/'.join(parts)
+
+
+async def get_identifiers(scope: str, scheduler: RequestScheduler) -> List[str]:
+    """ The identifiers of the packages in the scope. """
+    url = 'https://{}/package/eml/{}'.format(PASTA_DOMAIN, scope)
+    return (await scheduler.get_text(url)).split()
+
+
+async def get_doi(pid: str, scheduler: RequestScheduler) -> str:
+    """ The DOI of a package revision, from PASTA. """
+    url = 'https://{}/package/doi/eml/{}'.format(PASTA_DOMAIN, pid.replace(METADATA_PID_PREFIX, ''))
+    return (await scheduler.get_text(url)).strip()
+
+
+async def on_member_node(mn: str, pid: str, scheduler: RequestScheduler) -> bool:
+    """ Whether the member node has the object, from a describe request. """
+    object_url = 'https://{}/mn/v2/object/{}'.format(mn, urllib.parse.quote_plus(pid))
+
+    async def describe():
+        async with scheduler.request('HEAD', object_url) as resp:
+            if resp.status == 404:
+                return False
+            resp.raise_for_status()
+            return True
+
+    return await scheduler.retry(describe, 'describing ' + pid)
+
+
+async def process_package(package: str, scheduler: RequestScheduler, store: DOI_PID_store, mn: str = None):
+    """
+    Create the records of the package's revisions, from its list of revisions and
+    their DOIs. If mn is given, revisions not on the member node are left out.
+    """
+    try:
+        revisions = await pasta.get_revisions(package, scheduler)
+    except:
+        print('Exception: ', sys.exc_info()[0], flush=True)
+        print('Gave up getting the revisions of', package, flush=True)
+        return
+    pids = ['{}{}/{}'.format(METADATA_PID_PREFIX, package, revision) for revision in revisions]
+
+    if mn:
+        results = await asyncio.gather(*[on_member_node(mn, pid, scheduler) for pid in pids],
+                                       return_exceptions=True)
+        for pid, result in zip(pids, results):
+            if result is not True:
+                print('Not on {}, left out: {} {}'.format(
+                    mn, pid, '' if result is False else repr(result)), flush=True)
+        pids = [pid for pid, result in zip(pids, results) if result is True]
+
+    dois = store.lookup_dois(pids)
+    missing = [pid for pid in pids if pid not in dois]
+    if missing:
+        results = await asyncio.gather(*[get_doi(pid, scheduler) for pid in missing],
+                                       return_exceptions=True)
+        learned = []
+        for pid, result in zip(missing, results):
+            if isinstance(result, Exception) or not result:
+                print('DOI not found for {}: {}'.format(pid, repr(result)), flush=True)
+                continue
+            dois[pid] = result
+            learned.append((result, pid))
+        store.save_many(learned)
+
+    # Leave out the revisions whose DOIs weren't found, linking each record only to
+    # revisions that have records, so every PID in the chains comes with its DOI
+    pids = [pid for pid in pids if pid in dois]
+    records = []
+    for i, pid in enumerate(pids):
+        preceding = pids[i - 1] if i > 0 else ''
+        following = pids[i + 1] if i + 1 < len(pids) else ''
+        records.append(Chain_record(
+            dois[pid],
+            dois.get(preceding, ''),
+            dois.get(following, ''),
+            pid,
+            preceding,
+            following))
+    package_records[package] = records
+
+
+async def run_package_tasks(packages: List[str], scheduler_settings: Scheduler_settings,
+                            response_cache: ResponseCache, store: DOI_PID_store, mn: str = None):
+    """
+    Process the packages, keeping up to concurrency requests in flight and limiting
+    the request rate so we don't do a denial of service attack on PASTA.
+    """
+    count = 0
+
+    async def process_and_count(package: str):
+        nonlocal count
+        await process_package(package, scheduler, store, mn)
+        count += 1
+        if count % 100 == 0:   # Just so we can see signs of life...
+            print('count = {}, time = {}'.format(count, datetime.now().strftime("%H:%M:%S")), flush=True)
+
+    async with RequestScheduler(scheduler_settings, response_cache) as scheduler:
+        keys = []
+        for key in packages:
+            if '/' in key:
+                keys.append(key)
+                continue
+            # A scope, standing for all of its packages
+            try:
+                identifiers = await get_identifiers(key, scheduler)
+            except:
+                print('Exception: ', sys.exc_info()[0], flush=True)
+                print('Gave up getting the packages in', key, flush=True)
+                continue
+            print('{} packages in {}'.format(len(identifiers), key), flush=True)
+            keys.extend('{}/{}'.format(key, identifier) for identifier in identifiers)
+        for key in keys:
+            package_records[key] = []
+        await scheduler.run(process_and_count, list(package_records))
+    print('count = {}, time = {}'.format(count, datetime.now().strftime("%H:%M:%S")), flush=True)
+
+
+def read_package_file(package_filename: str) -> List[str]:
+    packages = []
+    with open(package_filename, mode='r') as package_file:
+        for line in package_file:
+            if not line.strip():
+                continue
+            key = package_key(line)
+            if key not in packages:
+                packages.append(key)
+    return packages
+
+
+def save_to_csv(csv_filename: str):
+    with open(csv_filename, mode='w') as obsolescence_csv:
+        csv_writer = csv.writer(
+            obsolescence_csv,
+            delimiter=',',
+            quotechar='"',
+            quoting=csv.QUOTE_MINIMAL)
+        csv_writer.writerow(COLUMNS)
+        for doi_record in doi_records.values():
+            csv_writer.writerow(list(doi_record))
+
+
+def main(package_filename: str, csv_filename: str, scheduler_settings: Scheduler_settings,
+         cache: str, cache_ttl: float, doi_store: str, mn: str = None):
+    packages = read_package_file(package_filename)
+    print('{} packages or scopes in {}'.format(len(packages), package_filename), flush=True)
+    response_cache = ResponseCache(cache, cache_ttl) if cache else None
+    store = DOI_PID_store(doi_store)
+    asyncio.run(run_package_tasks(packages, scheduler_settings, response_cache, store, mn))
+    store.close()
+    if response_cache:
+        response_cache.close()
+    for records in package_records.values():
+        for doi_record in records:
+            doi_records[doi_record.doi] = doi_record
+    save_to_csv(csv_filename)
+
+
+if __name__ == '__main__':
+    print(datetime.now().strftime("%H:%M:%S"), flush=True)
+    try:
+        get_obsolescence_chains_from_pasta()
+    finally:
+        # click exits via sys.exit(), so we use try/finally to get the ending datetime to display
+        print(datetime.now().strftime("%H:%M:%S"), flush=True)
@@ -4,14 +4,14 @@
 import collections
 from datetime import datetime
 import sys
-import time
 from typing import List
 import urllib.parse
 
-from aiohttp import ClientSession
 import asyncio
 import click
-import xml.etree.ElementTree as ET
+
+from request_scheduler import RequestScheduler, Scheduler_settings, scheduler_options
+from sysmeta_fields import extract_fields
 
 
 @click.command()
@@ -28,8 +28,10 @@ import xml.etree.ElementTree as ET
     default="mn",
     help="type of node: mn or cn, default=mn"
 )
+@scheduler_options()
 def get_system_metadata_obsolescence_info(
-    pids_list_file: str, obsolescence_info_csv_file: str, d: str, t: str
+    pids_list_file: str, obsolescence_info_csv_file: str, d: str, t: str,
+    scheduler_settings: Scheduler_settings
 ):
     """
     Query a MN or CN to get the system metadata corresponding to a list of PIDs and output the PID, obsoletes, and obsoletedBy in an output CSV file.
@@ -44,19 +46,15 @@ Arguments: \n
         print("Requires Python 3.7 or later")
         exit(0)
 
-    main(pids_list_file, obsolescence_info_csv_file, d, t)
-
-
-MAX_RETRIES = 3
-BURST_SIZE = 10
+    main(pids_list_file, obsolescence_info_csv_file, d, t, scheduler_settings)
 
 
-metadata_records = collections.OrderedDict()
 output_records = collections.OrderedDict()
 failures = collections.OrderedDict()
 
 
-async def get_metadata(domain: str, node_type: str, pid: str, session: ClientSession, **kwargs) -> str:
+async def get_metadata(domain: str, node_type: str, pid: str, scheduler: RequestScheduler,
+                       **kwargs) -> str:
     # print('get_metadata', domain, node_type, pid)
     """
     Retrieve system metadata for a package. This is the metadata to which obsolescence
@@ -64,63 +62,55 @@ async def get_metadata(domain: str, node_type: str, pid: str, session: ClientSes
     """
     metadata_url = 'https://{}/{}/v2/meta/{}'.format(domain, node_type, urllib.parse.quote_plus(pid))
     # print(metadata_url)
-    resp = await session.request(method='GET', url=metadata_url, **kwargs)
-    resp.raise_for_status()
-    return await resp.text()
+    return await scheduler.get_text(metadata_url, **kwargs)
 
 
-async def save_metadata(domain: str, node_type: str, pid: str, session: ClientSession):
+async def save_metadata(domain: str, node_type: str, pid: str, scheduler: RequestScheduler):
     """
-    Save the returned metadata in the metadata_records dict. Handle needed retries, if any.
+    Save the obsolescence information in the returned metadata in the output_records
+    dict, as soon as it arrives, so only the metadata in flight is held in memory.
+    Handle needed retries, if any.
     """
-    global metadata_records
-    retries = 0
-    while retries < MAX_RETRIES:
-        try:
-            metadata_response = await get_metadata(domain, node_type, pid, session)
-            break  # no exception, so break out of the retry loop
-        except:
-            print('Exception: ', sys.exc_info()[0], flush=True)
-            retries += 1
-            print('retries:', retries, ' ', pid, '  getting metadata', flush=True)
-            if retries >= MAX_RETRIES:
-                print('Reached max retries getting metadata. Giving up...', flush=True)
-                failures[pid] = sys.exc_info()[0]
-                return
-            time.sleep(1)
-    metadata_records[pid] = metadata_response
-
-
-async def run_get_metadata_tasks(domain: str, node_type: str, pids: List[str]):
+    try:
+        metadata_response = await get_metadata(domain, node_type, pid, scheduler)
+    except:
+        print('Exception: ', sys.exc_info()[0], flush=True)
+        print('Gave up getting metadata for', pid, flush=True)
+        failures[pid] = sys.exc_info()[0]
+        output_records[pid] = (pid, 'FAILED', 'FAILED')
+        return
+    parse_metadata(metadata_response)
+
+
+async def run_get_metadata_tasks(domain: str, node_type: str, pids: List[str],
+                                 scheduler_settings: Scheduler_settings):
     """
-    Fire off a list of tasks to get metadata and save it in the metadata_records
-    table.
+    Get metadata for a list of pids and save its obsolescence information in the
+    output_records table.
+    Up to concurrency requests are kept in flight, and the request rate is
+    limited so we don't do a denial of service attack on the node.
     """
-    async with ClientSession() as session:
-        tasks = [save_metadata(domain, node_type, pid, session) for pid in pids]
-        await asyncio.gather(*tasks)
+    count = 0
+
+    async def get_and_count(pid: str):
+        nonlocal count
+        await save_metadata(domain, node_type, pid, scheduler)
+        count += 1
+        if count % 1000 == 0:   # Just so we can see signs of life...
+            print('count = {}, time = {}'.format(count, datetime.now().strftime("%H:%M:%S")), flush=True)
+
+    async with RequestScheduler(scheduler_settings) as scheduler:
+        await scheduler.run(get_and_count, pids)
+    print('count = {}, time = {}'.format(count, datetime.now().strftime("%H:%M:%S")), flush=True)
 
 
 def parse_metadata(metadata: str):
-    root = ET.fromstring(metadata)
-    identifier_elements = root.findall('identifier')
-    identifier = identifier_elements[0].text
-    obsoletes_elements = root.findall('obsoletes')
-    if len(obsoletes_elements) > 0:
-        obsoletes = obsoletes_elements[0].text
-    else:
-        obsoletes = ''
-    obsoletedBy_elements = root.findall('obsoletedBy')
-    if len(obsoletedBy_elements) > 0:
-        obsoletedBy = obsoletedBy_elements[0].text
-    else:
-        obsoletedBy = ''
-    output_records[identifier] = (identifier, obsoletes, obsoletedBy)
-
-
-def main(pids_list_filename: str, obsolescence_info_csv_filename: str, domain: str, node_type: str):
-
-    global metadata_records
+    identifier, obsoletes, obsoletedBy = extract_fields(metadata)
+    output_records[identifier] = (identifier, obsoletes or '', obsoletedBy or '')
+
+
+def main(pids_list_filename: str, obsolescence_info_csv_filename: str, domain: str, node_type: str,
+         scheduler_settings: Scheduler_settings):
 
     # Read in the PIDs
     pids_list = []
@@ -134,30 +124,7 @@ def main(pids_list_filename: str, obsolescence_info_csv_filename: str, domain: s
 
     # Go get the metadata
     print('\nGetting metadata', flush=True)
-    count = 0
-    pids = []
-    for pid in pids_list:
-        pids.append(pid)
-        count += 1
-        # Access the member node in bursts so we don't do a denial of service attack on it
-        if count % BURST_SIZE == 0:
-            # Create tasks to get metadata
-            asyncio.run(run_get_metadata_tasks(domain, node_type, pids))
-            time.sleep(1)
-            pids = []
-        if count % 1000 == 0:   # Just so we can see signs of life...
-            print('count = {}, time = {}'.format(count, datetime.now().strftime("%H:%M:%S")), flush=True)
-    asyncio.run(run_get_metadata_tasks(domain, node_type, pids))
-    print('count = {}, time = {}'.format(count, datetime.now().strftime("%H:%M:%S")), flush=True)
-
-    # Now that we've got the metadata, check it against the expected values
-    print('\nParsing metadata', flush=True)
-    print(flush=True)
-    for pid in pids_list:
-        if pid in metadata_records:
-            parse_metadata(metadata_records[pid])
-        else:
-            output_records[pid] = (pid, 'FAILED', 'FAILED')
+    asyncio.run(run_get_metadata_tasks(domain, node_type, pids_list, scheduler_settings))
 
     # Write the output
     with open(obsolescence_info_csv_filename, 'wt') as obsolescence_info_csv_file:
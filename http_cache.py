@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Persistent on-disk cache of HTTP GET responses, shared by the scripts so that
+reruns, and later stages of a repair, don't download the same system metadata
+and ORE objects again.
+
+Responses are stored in a SQLite database keyed by URL, along with their ETag
+and Last-Modified headers. A cached response younger than the TTL is used as
+is. An older one is revalidated with If-None-Match / If-Modified-Since, and
+is used if the server answers 304 Not Modified.
+"""
+
+import sqlite3
+import time
+
+import click
+
+
+DEFAULT_TTL = 0
+
+
+def cache_options(f):
+    """
+    Decorator adding the --cache and --cache-ttl options to a click command.
+    The command function receives them as the `cache` and `cache_ttl` arguments.
+    """
+    f = click.option(
+        "--cache-ttl",
+        default=DEFAULT_TTL,
+        help="seconds for which a cached response is used without revalidating it. "
+             "default: {}, i.e., always revalidate".format(DEFAULT_TTL)
+    )(f)
+    f = click.option(
+        "--cache",
+        default=None,
+        help="SQLite file in which to cache HTTP responses. default: no caching"
+    )(f)
+    return f
+
+
+class CachedResponse:
+    def __init__(self, body: bytes, encoding: str, etag: str, last_modified: str, fetched: float):
+        self.body = body
+        self.encoding = encoding
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched = fetched
+
+    def text(self) -> str:
+        return self.body.decode(self.encoding or 'utf-8')
+
+
+class ResponseCache:
+    """
+    Cache of GET responses keyed by URL. Entries are used without revalidation
+    for ttl seconds after they were fetched or last revalidated.
+    """
+
+    def __init__(self, path: str, ttl: float = DEFAULT_TTL):
+        self.ttl = ttl
+        self.connection = sqlite3.connect(path, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'url TEXT PRIMARY KEY, body BLOB, encoding TEXT, etag TEXT, '
+            'last_modified TEXT, fetched REAL)')
+
+    def close(self):
+        self.connection.close()
+
+    def lookup(self, url: str):
+        """ Returns the CachedResponse for the url, or None. """
+        row = self.connection.execute(
+            'SELECT body, encoding, etag, last_modified, fetched FROM responses WHERE url = ?',
+            (url,)).fetchone()
+        if row is None:
+            return None
+        return CachedResponse(*row)
+
+    def is_fresh(self, cached: CachedResponse) -> bool:
+        return time.time() - cached.fetched < self.ttl
+
+    @staticmethod
+    def conditional_headers(cached: CachedResponse) -> dict:
+        """ Headers for revalidating a cached response. """
+        headers = {}
+        if cached is not None:
+            if cached.etag:
+                headers['If-None-Match'] = cached.etag
+            if cached.last_modified:
+                headers['If-Modified-Since'] = cached.last_modified
+        return headers
+
+    def store(self, url: str, body: bytes, encoding: str, etag: str, last_modified: str):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+            (url, body, encoding, etag, last_modified, time.time()))
+
+    def touch(self, url: str):
+        """ Mark a cached response as revalidated. """
+        self.connection.execute(
+            'UPDATE responses SET fetched = ? WHERE url = ?', (time.time(), url))
+
+    def invalidate(self, url: str):
+        """ Drop a cached response, e.g., after the resource has been updated. """
+        self.connection.execute('DELETE FROM responses WHERE url = ?', (url,))
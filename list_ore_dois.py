@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import collections
+from datetime import datetime
+import sys
+import urllib.parse
+
+import click
+import xml.etree.ElementTree as ET
+
+from request_scheduler import RequestScheduler, Scheduler_settings, scheduler_options
+
+
+ORE_FORMAT_ID = 'http://www.openarchives.org/ore/terms'
+DOI_PREFIX = 'doi:10.6073/pasta/'
+PAGE_SIZE = 1000
+PARALLEL_PAGES = 4
+
+
+@click.command()
+@click.option('-m',
+    default='gmn.lternet.edu',
+    help='member node: e.g., gmn.lternet.edu, gmn.edirepository.org. default: gmn.lternet.edu')
+@click.option('-p',
+    default=DOI_PREFIX,
+    help='prefix of the DOIs to list. default: {}'.format(DOI_PREFIX))
+@click.option('--since',
+    default=None,
+    help='list only ORE objects whose system metadata was modified since this date-time, '
+         'e.g., 2019-04-01T00:00:00.000+00:00')
+@scheduler_options()
+@click.argument('doi_file')
+def list_ore_dois(m: str, p: str, since: str, scheduler_settings: Scheduler_settings, doi_file: str):
+    """
+    Generates a list of the DOIs of the ORE objects on a DataONE Generic Member Node, using the
+    member node's listObjects API. This takes the place of the server-side SQL query.
+
+Arguments: \n
+        DOI_FILE: the text file to be generated, with one DOI per line
+
+        get_obsolescence_chains.py can also get the DOIs directly from the member node, without
+        an intermediate file. See its --help.
+    """
+
+    # Check the Python version
+    if (sys.version_info < (3, 7)):
+        print('Requires Python 3.7 or later')
+        exit(0)
+
+    main(m, p, since, doi_file, scheduler_settings)
+
+
+async def get_object_list(mn: str, start: int, count: int, scheduler: RequestScheduler,
+                          from_date: str = None, format_id: str = ORE_FORMAT_ID):
+    """
+    Get a page of the member node's list of ORE objects, optionally only those whose
+    system metadata was modified since from_date. Returns the total number of such
+    ORE objects and the identifiers on the page. If format_id is None, objects of
+    all formats are listed.
+    """
+    list_url = 'https://{}/mn/v2/object?start={}&count={}'.format(mn, start, count)
+    if format_id:
+        list_url += '&formatId={}'.format(urllib.parse.quote_plus(format_id))
+    if from_date:
+        list_url += '&fromDate={}'.format(urllib.parse.quote_plus(from_date))
+    # A missing page would silently drop DOIs, so failures are raised, not skipped
+    object_list = await scheduler.get_text(list_url)
+
+    root = ET.fromstring(object_list)
+    identifiers = [object_info.findtext('identifier') for object_info in root.findall('objectInfo')]
+    return int(root.get('total')), identifiers
+
+
+async def list_objects(mn: str, scheduler: RequestScheduler, prefix: str, since: str = None,
+                       format_id: str = None):
+    """
+    Yield the identifiers that start with prefix of the objects on the member node, as the
+    pages of the object list arrive. Up to PARALLEL_PAGES pages are requested at once, and
+    the identifiers are yielded in page order. If since is given, only objects whose system
+    metadata was modified since then are listed. If format_id is given, only objects of
+    that format are listed.
+    """
+    total, identifiers = await get_object_list(mn, 0, PAGE_SIZE, scheduler, since, format_id)
+    starts = iter(range(PAGE_SIZE, total, PAGE_SIZE))
+    pages = collections.deque()
+
+    def request_next_page():
+        start = next(starts, None)
+        if start is not None:
+            pages.append(asyncio.ensure_future(
+                get_object_list(mn, start, PAGE_SIZE, scheduler, since, format_id)))
+
+    for _ in range(PARALLEL_PAGES):
+        request_next_page()
+    while True:
+        for identifier in identifiers:
+            if identifier.startswith(prefix):
+                yield identifier
+        if not pages:
+            break
+        _, identifiers = await pages.popleft()
+        request_next_page()
+
+
+async def stream_ore_dois(mn: str, scheduler: RequestScheduler, doi_prefix: str = DOI_PREFIX,
+                          from_date: str = None):
+    """
+    Yield the DOIs of the ORE objects on the member node as the pages of the object list
+    arrive. If from_date is given, only ORE objects whose system metadata was modified
+    since then are listed.
+    """
+    async for doi in list_objects(mn, scheduler, doi_prefix, from_date, ORE_FORMAT_ID):
+        yield doi
+
+
+async def write_doi_file(mn: str, doi_prefix: str, since: str, doi_filename: str, 
+                         scheduler_settings: Scheduler_settings):
+    count = 0
+    async with RequestScheduler(scheduler_settings) as scheduler:
+        with open(doi_filename, mode='w') as doi_file:
+            async for doi in stream_ore_dois(mn, scheduler, doi_prefix, since):
+                doi_file.write('{}\n'.format(doi))
+                count += 1
+                if count % 10000 == 0:   # Just so we can see signs of life...
+                    print('count = {}, time = {}'.format(count, datetime.now().strftime("%H:%M:%S")), flush=True)
+    print('count = {}, time = {}'.format(count, datetime.now().strftime("%H:%M:%S")), flush=True)
+
+
+def main(mn: str, doi_prefix: str, since: str, doi_filename: str, scheduler_settings: Scheduler_settings):
+    asyncio.run(write_doi_file(mn, doi_prefix, since, doi_filename, scheduler_settings))
+
+
+if __name__ == '__main__':
+    print(datetime.now().strftime("%H:%M:%S"), flush=True)
+    try:
+        list_ore_dois()
+    finally:
+        # click exits via sys.exit(), so we use try/finally to get the ending datetime to display
+        print(datetime.now().strftime("%H:%M:%S"), flush=True)
@@ -2,12 +2,12 @@
 # -*- coding: utf-8 -*-
 
 import collections
-import csv
 from datetime import datetime
 import sys
 
 import click
-from namedlist import namedlist
+
+from chains_csv import read_chains, stop_on_chains_file_error
 
 
 @click.command()
@@ -36,23 +36,14 @@ Arguments: \n
 
 
 doi_records = collections.OrderedDict()
-DOI_record = namedlist(
-    'DOI_record', 
-    'doi obsoletes obsoletedBy metadataPID metadataObsoletesPID metadataObsoletedByPID',
-    default=None)
 
 doi_to_pid_map = collections.OrderedDict()
 
 
 def main(obsolescence_chains_csv_file: str, output_tsv_file: str):
     # Read in the DOI records
-    with open(obsolescence_chains_csv_file, 'r') as input_csv_file:
-        input_csv_file.seek(0)
-        csvreader = csv.reader(input_csv_file, delimiter=',')
-        # skip the header
-        next(csvreader)
-        for row in csvreader:
-            doi_record = DOI_record(*row)
+    with stop_on_chains_file_error():
+        for doi_record in read_chains(obsolescence_chains_csv_file, resolved=False):
             if (doi_record.metadataObsoletesPID or doi_record.metadataObsoletedByPID):
                 pid = doi_record.metadataPID
                 doi_records[pid] = doi_record
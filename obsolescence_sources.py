@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Sources of the obsolescence information of a metadata PID, for
+check_obsolescence_entries.py, which compares each PID's expected
+obsoletes and obsoletedBy values with those of every selected source in a
+single pass.
+
+A source looks up the (obsoletes, obsoletedBy) values of one PID at a time,
+with '' for a value that is absent, using the requests of a shared
+RequestScheduler. The member node and coordinating node sources read them
+from the PID's system metadata. The PASTA source works them out from the
+package's list of revisions, as the PIDs of the revisions before and after
+the PID's, getting each package's list once however many of its PIDs are
+looked up. The lists of the most recently looked up packages are kept, up to
+MAX_PACKAGES of them, and a list that couldn't be got is asked for again the
+next time it's needed.
+
+check_consistency and print_differences print the differences between the
+expected and found values in the form the check scripts use, so that
+check_metadata_obsolescence_entries.py and check_coordinating_node_entries.py
+share them, and the system metadata sources, with check_obsolescence_entries.py.
+"""
+
+import asyncio
+import collections
+import difflib
+from typing import Dict, List, Tuple
+import urllib.parse
+
+from request_scheduler import RequestScheduler
+from sysmeta_fields import extract_fields
+
+
+PASTA_DOMAIN = 'pasta.lternet.edu'
+METADATA_PID_PREFIX = 'https://pasta.lternet.edu/package/metadata/eml/'
+# The number of packages whose lists of revisions are kept
+MAX_PACKAGES = 1000
+FIELDS = ('obsoletes', 'obsoletedBy')
+
+
+def obsolescence_values(metadata: str) -> Tuple[str, str]:
+    """ The obsoletes and obsoletedBy values in the system metadata, '' for those absent. """
+    fields = extract_fields(metadata)
+    return fields.obsoletes or '', fields.obsoletedBy or ''
+
+
+class Sysmeta_source:
+    """ The obsolescence information in the system metadata on a member or coordinating node. """
+
+    def __init__(self, name: str, domain: str, node_type: str):
+        self.name = name
+        self.domain = domain
+        self.node_type = node_type
+
+    def metadata_url(self, pid: str) -> str:
+        return 'https://{}/{}/v2/meta/{}'.format(self.domain, self.node_type, urllib.parse.quote_plus(pid))
+
+    async def get_metadata(self, pid: str, scheduler: RequestScheduler) -> str:
+        return await scheduler.get_text(self.metadata_url(pid))
+
+    async def lookup(self, pid: str, scheduler: RequestScheduler) -> Tuple[str, str]:
+        return obsolescence_values(await self.get_metadata(pid, scheduler))
+
+
+class PASTA_source:
+    """ The obsolescence information implied by the lists of package revisions in PASTA. """
+
+    name = 'PASTA'
+
+    def __init__(self, domain: str = PASTA_DOMAIN):
+        self.domain = domain
+        # Each package's list of revisions, keyed by 'scope/identifier', as a task so the
+        # PIDs of a package looked up at the same time share one request. The least
+        # recently looked up packages come first.
+        self.revisions: Dict[str, asyncio.Task] = collections.OrderedDict()
+
+    def forget_failed(self, package: str, task: asyncio.Task):
+        """ Drop a package's list of revisions that couldn't be got, so it's asked for again. """
+        if (task.cancelled() or task.exception() is not None) and self.revisions.get(package) is task:
+            del self.revisions[package]
+
+    async def get_revisions(self, package: str, scheduler: RequestScheduler) -> List[int]:
+        url = 'https://{}/package/eml/{}'.format(self.domain, package)
+        return sorted(int(revision) for revision in (await scheduler.get_text(url)).split())
+
+    async def lookup(self, pid: str, scheduler: RequestScheduler) -> Tuple[str, str]:
+        scope, identifier, revision = pid.replace(METADATA_PID_PREFIX, '').split('/')
+        package = '{}/{}'.format(scope, identifier)
+        task = self.revisions.get(package)
+        if task is None:
+            task = asyncio.ensure_future(self.get_revisions(package, scheduler))
+            task.add_done_callback(lambda task: self.forget_failed(package, task))
+            self.revisions[package] = task
+            if len(self.revisions) > MAX_PACKAGES:
+                self.revisions.popitem(last=False)
+        else:
+            self.revisions.move_to_end(package)
+        revisions = await asyncio.shield(task)
+        if int(revision) not in revisions:
+            raise LookupError('{} is not in PASTA'.format(pid))
+        i = revisions.index(int(revision))
+        obsoletes = '{}{}/{}'.format(METADATA_PID_PREFIX, package, revisions[i - 1]) if i > 0 else ''
+        obsoletedBy = '{}{}/{}'.format(METADATA_PID_PREFIX, package, revisions[i + 1]) \
+            if i + 1 < len(revisions) else ''
+        return obsoletes, obsoletedBy
+
+
+def print_differences(field: str, expected: str, found: str, source: str = None):
+    """ Print an expected field value and the different one found, with a character diff. """
+    label = '{} {}'.format(source, field) if source else field
+    print('   Expected {}={}'.format(label, ascii(expected)), flush=True)
+    print('   Found {}   ={}'.format(label, ascii(found)), flush=True)
+    print('\n'.join(difflib.ndiff([expected], [found])))
+
+
+def print_field_differences(expected: Tuple[str, str], found: Tuple[str, str], source: str = None):
+    """ Print the differences between the expected and found (obsoletes, obsoletedBy) values. """
+    for field, expected_value, found_value in zip(FIELDS, expected, found):
+        if expected_value != found_value:
+            print_differences(field, expected_value, found_value, source)
+
+
+def check_consistency(pid: str, expected: Tuple[str, str], found: Tuple[str, str]) -> bool:
+    """
+    Check the (obsoletes, obsoletedBy) values found for the PID against the
+    expected ones, printing the PID and the differences if they don't agree.
+    Returns True if they agree.
+    """
+    if found is None:
+        print('Metadata not available for pid', pid, flush=True)
+        return False
+    if tuple(found) == tuple(expected):
+        return True
+    print(pid, flush=True)
+    print_field_differences(expected, found)
+    return False
@@ -20,13 +20,74 @@ import click
     default=None,
     help="TSV file with DOI to PID mapping"
 )
+@click.option(
+    "--concurrency",
+    default=None,
+    type=int,
+    help="max number of requests in flight, passed to each script. default: each script's default"
+)
+@click.option(
+    "--rate",
+    default=None,
+    type=float,
+    help="max requests per second to any one host, passed to each script. default: each script's default"
+)
+@click.option(
+    "--connect-timeout",
+    default=None,
+    type=float,
+    help="seconds to wait for a connection, passed to each script. default: each script's default"
+)
+@click.option(
+    "--read-timeout",
+    default=None,
+    type=float,
+    help="seconds to wait for data from a host, passed to each script. default: each script's default"
+)
+@click.option(
+    "--cache",
+    default=None,
+    help="SQLite file in which to cache HTTP responses across the steps, and across batches. "
+         "default: no caching"
+)
+@click.option(
+    "--cache-ttl",
+    default=None,
+    type=float,
+    help="seconds for which a cached response is used without revalidating it. "
+         "default: always revalidate"
+)
+@click.option(
+    "--incremental",
+    default=False,
+    is_flag=True,
+    help="repair only packages whose ORE objects have changed since the last run with the same "
+         "OUTPUT_FILE_PREFIX"
+)
+@click.option(
+    "--fingerprints",
+    default=None,
+    help="SQLite file of the fingerprints of verified system metadata, passed to the update and "
+         "check steps, which skip the objects that haven't changed since. default: no fingerprints"
+)
+@click.option(
+    "--full-check",
+    default=False,
+    is_flag=True,
+    help="check all of the PIDs with obsolescence information after the update step, rather than "
+         "just the PIDs it updated and their neighbors in the obsolescence chains"
+)
 def repair_obsolescence_batch(doi_file: str, start: str, end: str, member_node: str, 
-                              path_to_x509_cert: str, output_file_prefix: str, t: str):
+                              path_to_x509_cert: str, output_file_prefix: str, t: str,
+                              concurrency: int, rate: float, connect_timeout: float, 
+                              read_timeout: float, cache: str, cache_ttl: float,
+                              incremental: bool, fingerprints: str, full_check: bool):
     """
     Run a batch of DOIs through the obsolescence chain repair process.
 
 Arguments: \n
-        DOI_FILE: text file containing a list of DOIs, one per line \n
+        DOI_FILE: text file containing a list of DOIs, one per line, or listObjects to get
+        the DOIs from the member node \n
         START: 0-based index of first DOI to process in this batch\n
         END: 0-based index of last DOI to process; -1 for end of list\n
         MEMBER_NODE: e.g., gmn.lternet.edu
@@ -38,6 +99,14 @@ Arguments: \n
           - resolve_unresolved_dois.py
           - update_obsolescence_chains.py
           - check_metadata_obsolescence_entries.py
+
+        With --incremental, the obsolescence chains from the last run with the same
+        OUTPUT_FILE_PREFIX are updated with the ORE objects that have changed since then,
+        and only the changed records are resolved, repaired, and checked.
+
+        The check step checks just the PIDs the update step updated, and their
+        neighbors in the obsolescence chains, unless --full-check is given. The
+        update step has already found the rest to be as expected.
     """
 
     # Check the Python version
@@ -45,10 +114,42 @@ Arguments: \n
         print('Requires Python 3.7 or later')
         exit(0)
 
-    main(doi_file, int(start), int(end), member_node, path_to_x509_cert, output_file_prefix, t)
+    main(doi_file, int(start), int(end), member_node, path_to_x509_cert, output_file_prefix, t,
+         scheduler_args(concurrency, rate, connect_timeout, read_timeout, cache, cache_ttl), incremental,
+         ' --fingerprints {}'.format(fingerprints) if fingerprints else '', full_check)
+
+
+def scheduler_args(concurrency: int, rate: float, connect_timeout: float, read_timeout: float,
+                   cache: str, cache_ttl: float):
+    """ Command line options for the request scheduler and response cache, if specified. """
+    args = ''
+    if concurrency:
+        args += ' --concurrency {}'.format(concurrency)
+    if rate:
+        args += ' --rate {}'.format(rate)
+    if connect_timeout:
+        args += ' --connect-timeout {}'.format(connect_timeout)
+    if read_timeout:
+        args += ' --read-timeout {}'.format(read_timeout)
+    if cache:
+        args += ' --cache {}'.format(cache)
+        if cache_ttl:
+            args += ' --cache-ttl {}'.format(cache_ttl)
+    return args
+
+
+def run_step(cmdline: str):
+    """ Run a step of the batch, stopping the batch if the step fails. """
+    print(cmdline)
+    if os.system(cmdline) != 0:
+        print('Step failed. Stopping.', flush=True)
+        exit(1)
 
 
 def read_doi_excerpt(doi_filename: str, start: int, end: int, output_file_prefix: str):
+    if doi_filename == 'listObjects':
+        # get_obsolescence_chains.py gets the DOIs from the member node
+        return doi_filename
     dois = []
     with open(doi_filename, mode='r') as doi_file:
         for doi in doi_file:
@@ -64,55 +165,73 @@ def read_doi_excerpt(doi_filename: str, start: int, end: int, output_file_prefix
     return excerpt_filename
 
 
-def get_obsolescence_chains(excerpt_filename: str, output_file_prefix: str, mn: str):
+def get_obsolescence_chains(excerpt_filename: str, output_file_prefix: str, mn: str,
+                            scheduler_args: str, incremental: bool):
     chains_filename = output_file_prefix + '_obsolescence_chains.csv'
     stdout_filename = output_file_prefix + '_obsolescence_chains.stdout'
-    cmdline = './get_obsolescence_chains.py {} {} -m {} > {}'.format(excerpt_filename, 
-        chains_filename, mn, stdout_filename)
-    print(cmdline)
-    os.system(cmdline)
+    if incremental:
+        # The following steps just need the records that changed
+        changes_filename = output_file_prefix + '_obsolescence_chains_changes.csv'
+        cmdline = './get_obsolescence_chains.py {} {} -m {}{} --incremental --changes {} > {}'.format(
+            excerpt_filename, chains_filename, mn, scheduler_args, changes_filename, stdout_filename)
+        chains_filename = changes_filename
+    else:
+        cmdline = './get_obsolescence_chains.py {} {} -m {}{} > {}'.format(excerpt_filename, 
+            chains_filename, mn, scheduler_args, stdout_filename)
+    run_step(cmdline)
     return chains_filename
 
 
-def resolve_unresolved_dois(chains_filename: str, output_file_prefix: str, tsv_file_name: str):
-    resolved_filename = output_file_prefix + '_obsolescence_chains_resolved.csv'
-    stdout_filename = output_file_prefix + '_obsolescence_chains_resolved.stdout'
+def resolve_unresolved_dois(chains_filename: str, output_file_prefix: str, tsv_file_name: str,
+                            scheduler_args: str):
+    # E.g., prefix_obsolescence_chains.csv -> prefix_obsolescence_chains_resolved.csv
+    resolved_filename = os.path.splitext(chains_filename)[0] + '_resolved.csv'
+    stdout_filename = os.path.splitext(resolved_filename)[0] + '.stdout'
     if tsv_file_name:
-        cmdline = './resolve_unresolved_dois.py {} {} -t {} > {}'.format(chains_filename, 
-            resolved_filename, tsv_file_name, stdout_filename)
+        cmdline = './resolve_unresolved_dois.py {} {} -t {}{} > {}'.format(chains_filename, 
+            resolved_filename, tsv_file_name, scheduler_args, stdout_filename)
     else:
-        cmdline = './resolve_unresolved_dois.py {} {} > {}'.format(chains_filename, 
-            resolved_filename, stdout_filename)        
-    print(cmdline)
-    os.system(cmdline)
+        cmdline = './resolve_unresolved_dois.py {} {}{} > {}'.format(chains_filename, 
+            resolved_filename, scheduler_args, stdout_filename)        
+    run_step(cmdline)
     return resolved_filename
 
 
 def update_obsolescence_chains(resolved_filename: str, path_to_x509_cert: str, 
-                               output_file_prefix: str, mn: str):
+                               output_file_prefix: str, mn: str, scheduler_args: str,
+                               fingerprint_args: str = ''):
     updates_filename = output_file_prefix + '_updates.tsv'
+    updated_filename = output_file_prefix + '_updated.csv'
     stdout_filename = output_file_prefix + '_updates.stdout'
-    cmdline = './update_obsolescence_chains.py {} {} -m {} -o {} > {}'.format(resolved_filename, 
-        path_to_x509_cert, mn, updates_filename, stdout_filename)
-    print(cmdline)
-    os.system(cmdline)
+    cmdline = './update_obsolescence_chains.py {} {} -m {} -o {} --updated {}{}{} > {}'.format(
+        resolved_filename, path_to_x509_cert, mn, updates_filename, updated_filename, scheduler_args,
+        fingerprint_args, stdout_filename)
+    run_step(cmdline)
+    return updated_filename
 
 
-def check_metadata_obsolescence_entries(resolved_filename: str, output_file_prefix: str, mn: str):
+def check_metadata_obsolescence_entries(resolved_filename: str, output_file_prefix: str, mn: str,
+                                        scheduler_args: str, fingerprint_args: str = '',
+                                        updated_filename: str = None):
     results_filename = output_file_prefix + '_results.txt'
-    cmdline = './check_metadata_obsolescence_entries.py {} -m {} > {}'.format(resolved_filename, 
-        mn, results_filename)
-    print(cmdline)
-    os.system(cmdline)
+    verify_args = ' --verify {} --neighbors'.format(updated_filename) if updated_filename else ''
+    cmdline = './check_metadata_obsolescence_entries.py {} -m {}{}{}{} > {}'.format(resolved_filename, 
+        mn, scheduler_args, fingerprint_args, verify_args, results_filename)
+    run_step(cmdline)
 
 
 def main(doi_filename: str, start: int, end: int, mn: str, path_to_x509_cert: str, 
-         output_file_prefix: str, tsv_file_name: str):
+         output_file_prefix: str, tsv_file_name: str, scheduler_args: str, incremental: bool,
+         fingerprint_args: str = '', full_check: bool = False):
     excerpt_filename = read_doi_excerpt(doi_filename, start, end, output_file_prefix)
-    chains_filename = get_obsolescence_chains(excerpt_filename, output_file_prefix, mn)
-    resolved_filename = resolve_unresolved_dois(chains_filename, output_file_prefix, tsv_file_name)
-    update_obsolescence_chains(resolved_filename, path_to_x509_cert, output_file_prefix, mn)
-    check_metadata_obsolescence_entries(resolved_filename, output_file_prefix, mn)
+    chains_filename = get_obsolescence_chains(excerpt_filename, output_file_prefix, mn, 
+                                              scheduler_args, incremental)
+    resolved_filename = resolve_unresolved_dois(chains_filename, output_file_prefix, tsv_file_name,
+                                                scheduler_args)
+    updated_filename = update_obsolescence_chains(resolved_filename, path_to_x509_cert,
+                                                  output_file_prefix, mn, scheduler_args, fingerprint_args)
+    check_metadata_obsolescence_entries(resolved_filename, output_file_prefix, mn, scheduler_args,
+                                        fingerprint_args, None if full_check else updated_filename)
 
 
 if __name__ == '__main__':
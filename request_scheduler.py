@@ -0,0 +1,380 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Request scheduling shared by the scripts that fetch from member nodes,
+coordinating nodes, and PASTA.
+
+Rather than firing off fixed bursts of requests and sleeping between
+them, a RequestScheduler keeps up to `concurrency` requests in flight at
+all times and caps the request rate to each host with a token bucket.
+
+Transient failures (connection errors, timeouts, 408, 429 and 5xx
+responses) are retried with jittered exponential backoff, honoring
+Retry-After. Other 4xx responses are not retried. The number of requests
+in flight is adjusted additively up and multiplicatively down (AIMD),
+according to the latency and the transient failures seen, with
+`concurrency` as the ceiling.
+
+All of a run's requests go through one pool of keep-alive connections,
+with DNS lookups cached and, if a client certificate is needed, one SSL
+context with the certificate loaded once.
+"""
+
+import asyncio
+import collections
+import contextlib
+from datetime import datetime, timezone
+import email.utils
+import functools
+import random
+import ssl
+import time
+from typing import Any, AsyncIterable, Awaitable, Callable, Iterable, Optional, Union
+import urllib.parse
+
+from aiohttp import ClientError, ClientResponseError, ClientSession, ClientTimeout, TCPConnector
+import click
+
+from http_cache import ResponseCache
+
+
+DEFAULT_CONCURRENCY = 10
+DEFAULT_RATE = 10.0
+DEFAULT_CONNECT_TIMEOUT = 15.0
+DEFAULT_READ_TIMEOUT = 60.0
+DNS_CACHE_TTL = 300
+KEEPALIVE_TIMEOUT = 60.0
+
+MAX_RETRIES = 3
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+
+# A request taking this many times longer than the baseline latency is a sign of overload
+LATENCY_FACTOR = 3.0
+# The baseline latency creeps up by this factor per request, so one fast outlier doesn't stick
+BASELINE_DRIFT = 1.01
+# Don't cut the limit more often than this many seconds
+DECREASE_INTERVAL = 1.0
+
+
+Scheduler_settings = collections.namedtuple(
+    'Scheduler_settings', 'concurrency rate connect_timeout read_timeout')
+
+DEFAULT_SETTINGS = Scheduler_settings(
+    DEFAULT_CONCURRENCY, DEFAULT_RATE, DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT)
+
+
+def scheduler_options(concurrency: int = DEFAULT_CONCURRENCY, rate: float = DEFAULT_RATE):
+    """
+    Decorator adding the --concurrency, --rate, --connect-timeout and --read-timeout
+    options to a click command. The command function receives them as a
+    Scheduler_settings, in the `scheduler_settings` argument.
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def command(*args, concurrency, rate, connect_timeout, read_timeout, **kwargs):
+            scheduler_settings = Scheduler_settings(concurrency, rate, connect_timeout, read_timeout)
+            return f(*args, scheduler_settings=scheduler_settings, **kwargs)
+
+        command = click.option(
+            "--read-timeout",
+            default=DEFAULT_READ_TIMEOUT,
+            help="seconds to wait for data from a host, default: {}".format(DEFAULT_READ_TIMEOUT)
+        )(command)
+        command = click.option(
+            "--connect-timeout",
+            default=DEFAULT_CONNECT_TIMEOUT,
+            help="seconds to wait for a connection, default: {}".format(DEFAULT_CONNECT_TIMEOUT)
+        )(command)
+        command = click.option(
+            "--rate",
+            default=rate,
+            help="max requests per second to any one host, default: {}".format(rate)
+        )(command)
+        command = click.option(
+            "--concurrency",
+            default=concurrency,
+            help="max number of requests in flight, default: {}".format(concurrency)
+        )(command)
+        return command
+    return decorator
+
+
+def is_transient(exception: BaseException) -> bool:
+    """ Is the exception worth retrying? """
+    if isinstance(exception, ClientResponseError):
+        return exception.status in RETRY_STATUSES
+    return isinstance(exception, (ClientError, asyncio.TimeoutError))
+
+
+def retry_after(exception: BaseException) -> Optional[float]:
+    """ Seconds to wait according to a Retry-After header, or None. """
+    headers = getattr(exception, 'headers', None)
+    value = headers.get('Retry-After') if headers else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_time = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_time - datetime.now(timezone.utc)).total_seconds())
+
+
+def backoff_delay(retries: int, exception: BaseException) -> float:
+    """
+    Seconds to wait before the next try: what Retry-After asks for, if anything,
+    otherwise exponential backoff with full jitter.
+    """
+    delay = retry_after(exception)
+    if delay is None:
+        delay = random.uniform(0, BACKOFF_BASE * 2 ** retries)
+    return min(delay, BACKOFF_MAX)
+
+
+@functools.lru_cache(maxsize=None)
+def ssl_context(client_certificate_path: str = None) -> ssl.SSLContext:
+    """
+    SSL context for connecting to the nodes, presenting the X.509 client
+    certificate if one is given. Contexts are cached, so the certificate is
+    loaded once per run, however many connections use it.
+    """
+    context = ssl.create_default_context()
+    if client_certificate_path:
+        context.load_cert_chain(client_certificate_path)
+    return context
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter. Tokens accrue at `rate` per second, up to
+    `capacity`. Each request takes a token, waiting for one if none are left.
+    A rate of 0 means no limit.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1.0):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class AdaptiveLimit:
+    """
+    AIMD limit on the number of requests in flight. Each request that comes back
+    promptly raises the limit by 1/limit, i.e., by about one per round of
+    requests, up to max_limit. A transient failure, or a request taking much
+    longer than the baseline latency, halves it.
+    """
+
+    def __init__(self, max_limit: int):
+        self.max_limit = max_limit
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self.baseline = None
+        self.last_decrease = 0.0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self, latency: float = None, overloaded: bool = False):
+        async with self.condition:
+            self.in_flight -= 1
+            if latency is not None:
+                if self.baseline is None or latency < self.baseline:
+                    self.baseline = latency
+                else:
+                    self.baseline *= BASELINE_DRIFT
+                if latency > LATENCY_FACTOR * self.baseline:
+                    overloaded = True
+            if overloaded:
+                now = time.monotonic()
+                if now - self.last_decrease >= DECREASE_INTERVAL:
+                    self.limit = max(1.0, self.limit / 2)
+                    self.last_decrease = now
+            elif latency is not None:
+                self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+
+class RequestScheduler:
+    """
+    Keeps up to `concurrency` units of work in flight, and limits requests to
+    each host to `rate` per second. Use as an async context manager; it owns
+    the ClientSession used for the requests it issues. If a ResponseCache is
+    given, get_text uses it. If a client certificate is given, it is presented
+    to every host.
+    """
+
+    def __init__(self, settings: Scheduler_settings = DEFAULT_SETTINGS, cache: ResponseCache = None,
+                 client_certificate_path: str = None):
+        self.concurrency = max(1, settings.concurrency)
+        self.rate = settings.rate
+        self.timeout = ClientTimeout(
+            total=None, sock_connect=settings.connect_timeout, sock_read=settings.read_timeout)
+        self.cache = cache
+        self.client_certificate_path = client_certificate_path
+        self.buckets = {}
+        self.limit = None
+        self.session = None
+
+    async def __aenter__(self):
+        self.limit = AdaptiveLimit(self.concurrency)
+        # One pool of connections, reused for all requests to the same host
+        connector = TCPConnector(
+            limit=self.concurrency,
+            ttl_dns_cache=DNS_CACHE_TTL,
+            keepalive_timeout=KEEPALIVE_TIMEOUT,
+            ssl=ssl_context(self.client_certificate_path))
+        self.session = ClientSession(connector=connector, timeout=self.timeout)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    async def throttle(self, url: str):
+        """ Wait until the rate limit for the url's host allows another request. """
+        host = urllib.parse.urlsplit(url).hostname
+        bucket = self.buckets.get(host)
+        if bucket is None:
+            bucket = TokenBucket(self.rate)
+            self.buckets[host] = bucket
+        await bucket.acquire()
+
+    @contextlib.asynccontextmanager
+    async def request(self, method: str, url: str, **kwargs):
+        """
+        Issue a request once the host's rate limit and the limit on requests in
+        flight allow it. Use as an async context manager, which gives the
+        response. The request counts as in flight until the block is done with
+        the body, and then the response is released. The response time and
+        status feed the limit on requests in flight.
+        """
+        await self.throttle(url)
+        await self.limit.acquire()
+        started = time.monotonic()
+        try:
+            resp = await self.session.request(method=method, url=url, **kwargs)
+        except BaseException as exception:
+            await self.limit.release(overloaded=is_transient(exception))
+            raise
+        # The latency is that of the response headers, so large bodies don't count as slowness
+        latency = time.monotonic() - started
+        overloaded = resp.status in RETRY_STATUSES
+        try:
+            yield resp
+        except BaseException as exception:
+            overloaded = overloaded or is_transient(exception)
+            raise
+        finally:
+            resp.release()
+            await self.limit.release(latency=None if overloaded else latency, overloaded=overloaded)
+
+    async def retry(self, attempt: Callable[[], Awaitable], description: str):
+        """
+        Await attempt() until it succeeds, up to MAX_RETRIES times, waiting
+        between tries without blocking other requests. Only transient failures
+        are retried; anything else is raised right away.
+        """
+        retries = 0
+        while True:
+            try:
+                return await attempt()
+            except Exception as exception:
+                if not is_transient(exception):
+                    raise
+                print('Exception: ', exception.__class__, exception, flush=True)
+                retries += 1
+                print('retries:', retries, ' ', description, flush=True)
+                if retries >= MAX_RETRIES:
+                    print('Reached max retries {}. Giving up...'.format(description), flush=True)
+                    raise
+                await asyncio.sleep(backoff_delay(retries, exception))
+
+    async def get_text(self, url: str, **kwargs) -> str:
+        """
+        GET the url and return the response text, retrying transient failures
+        and raising an exception for other HTTP errors. A cached response is
+        used if it is fresh or if the server says it hasn't been modified, in
+        which case no body is transferred.
+        """
+        return await self.retry(lambda: self.get_text_once(url, **kwargs), 'getting ' + url)
+
+    async def get_text_once(self, url: str, **kwargs) -> str:
+        if self.cache is None:
+            async with self.request('GET', url, **kwargs) as resp:
+                resp.raise_for_status()
+                return await resp.text()
+
+        cached = self.cache.lookup(url)
+        if cached is not None and self.cache.is_fresh(cached):
+            return cached.text()
+        headers = dict(kwargs.pop('headers', {}))
+        headers.update(ResponseCache.conditional_headers(cached))
+        async with self.request('GET', url, headers=headers, **kwargs) as resp:
+            if resp.status == 304 and cached is not None:
+                self.cache.touch(url)
+                return cached.text()
+            resp.raise_for_status()
+            body = await resp.read()
+            encoding = resp.get_encoding()
+        self.cache.store(url, body, encoding, resp.headers.get('ETag'), resp.headers.get('Last-Modified'))
+        return body.decode(encoding)
+
+    async def run(self, worker: Callable[[Any], Awaitable[None]],
+                  items: Union[Iterable, AsyncIterable], concurrency: int = None):
+        """
+        Call worker(item) for each item, keeping up to `concurrency` calls in
+        flight, by default the scheduler's. As soon as one finishes, the next
+        item is started. Items may be a plain or an async iterable, and are
+        consumed lazily.
+        """
+        lock = asyncio.Lock()
+        if hasattr(items, '__aiter__'):
+            async_iterator = items.__aiter__()
+
+            async def next_item():
+                # Async generators can't be advanced by two tasks at once
+                async with lock:
+                    return await async_iterator.__anext__()
+        else:
+            iterator = iter(items)
+
+            async def next_item():
+                try:
+                    return next(iterator)
+                except StopIteration:
+                    raise StopAsyncIteration
+
+        async def consume():
+            while True:
+                try:
+                    item = await next_item()
+                except StopAsyncIteration:
+                    return
+                await worker(item)
+
+        workers = max(1, concurrency or self.concurrency)
+        await asyncio.gather(*[consume() for _ in range(workers)])
@@ -1,11 +1,19 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import asyncio
 import collections
-import csv
+from datetime import datetime
+import sys
+from typing import Iterable
+import urllib.parse
 
 import click
-import requests
+
+from chains_csv import COLUMNS, read_chains, stop_on_chains_file_error
+from doi_pid_store import DOI_PID_store, doi_store_option
+from http_cache import ResponseCache, cache_options
+from request_scheduler import RequestScheduler, Scheduler_settings, scheduler_options
 
 
 @click.command()
@@ -16,26 +24,102 @@ import requests
     default=None,
     help="TSV file with DOI to PID mapping"
 )
-def resolve_unresolved_dois(obsolescence_chains_csv_file: str, output_csv_file: str, t: str):
+@scheduler_options()
+@cache_options
+@doi_store_option
+@click.option(
+    "--landing-pages",
+    default=False,
+    is_flag=True,
+    help="resolve DOIs by downloading and parsing their landing pages, without first trying "
+         "to read the package ID from the DOI redirects"
+)
+def resolve_unresolved_dois(obsolescence_chains_csv_file: str, output_csv_file: str, t: str,
+                            scheduler_settings: Scheduler_settings, cache: str, cache_ttl: float,
+                            doi_store: str, landing_pages: bool):
     """
     Update a CSV file containing the obsolescence chains for DOIs associated with a DataONE Generic Member Node, replacing UNRESOLVED entries in the input CSV file. 
 
 Arguments: \n
         OBSOLESCENCE_CHAINS_CSV_FILE: obsolescence chains as output by get_obsolescence_chains.py \n
         OUTPUT_CSV_FILE: the obsolescence chains CSV file with UNRESOLVED entries resolved
+
+        DOIs are looked up in the DOI to PID store, which get_obsolescence_chains.py fills in,
+        before they are resolved. The PIDs resolved are added to it.
+
+        A DOI is resolved by following its redirects with HEAD requests until one of them points
+        to a landing page URL that includes the package ID. Only if none does is the landing page
+        downloaded and parsed.
     """
-    main(obsolescence_chains_csv_file, output_csv_file, t)
+    main(obsolescence_chains_csv_file, output_csv_file, t, scheduler_settings, cache, cache_ttl,
+         doi_store, landing_pages)
 
 
 UNRESOLVED = 'UNRESOLVED'
 PASTA_DOMAIN = 'pasta.lternet.edu'
+DOI_RESOLVER = 'http://dx.doi.org/'
+MAX_REDIRECTS = 5
+REDIRECT_STATUSES = {301, 302, 303, 307, 308}
 
 
-def doi2pid(doi: str):
+def landing_url_pid(url: str):
+    """
+    Get the PID from a landing page URL, e.g.,
+    https://portal.edirepository.org/nis/mapbrowse?scope=knb-lter-and&identifier=2725&revision=4
+    or https://portal.edirepository.org/nis/mapbrowse?packageid=knb-lter-and.2725.4
+    Returns None if the URL doesn't include the package ID.
+    """
+    query = urllib.parse.parse_qs(urllib.parse.urlsplit(url).query)
+    package_id = None
+    if all(name in query for name in ('scope', 'identifier', 'revision')):
+        package_id = [query['scope'][0], query['identifier'][0], query['revision'][0]]
+    elif 'packageid' in query:
+        package_id = query['packageid'][0].rsplit('.', 2)
+    if not package_id or len(package_id) != 3 or not all(package_id) or \
+            not package_id[1].isdigit() or not package_id[2].isdigit():
+        return None
+    return 'https://{}/package/metadata/eml/{}'.format(PASTA_DOMAIN, '/'.join(package_id))
+
+
+async def redirect_pid(doi: str, scheduler: RequestScheduler):
+    """
+    Get the PID corresponding to the DOI from the Location headers of its
+    redirects, without downloading any page. Returns None if no redirect
+    points to a landing page URL that includes the package ID.
+    """
+    url = DOI_RESOLVER + doi
+    for _ in range(MAX_REDIRECTS):
+
+        async def head():
+            async with scheduler.request('HEAD', url, allow_redirects=False) as resp:
+                if resp.status not in REDIRECT_STATUSES:
+                    resp.raise_for_status()
+                return resp
+
+        try:
+            resp = await scheduler.retry(head, 'following the redirects for ' + doi)
+        except:
+            print('Exception: ', sys.exc_info()[0], flush=True)
+            return None
+        location = resp.headers.get('Location')
+        if resp.status not in REDIRECT_STATUSES or not location:
+            return None
+        url = urllib.parse.urljoin(url, location)
+        pid = landing_url_pid(url)
+        if pid:
+            return pid
+    return None
+
+
+async def doi2pid(doi: str, scheduler: RequestScheduler):
     """ Get the PID corresponding to the DOI by parsing the landing page. """
     # Get the html for the landing page corresponding to the doi
-    url = "http://dx.doi.org/" + doi
-    html = requests.get(url).text
+    url = DOI_RESOLVER + doi
+    try:
+        html = await scheduler.get_text(url)
+    except:
+        print('Exception: ', sys.exc_info()[0], flush=True)
+        html = None
     if html:
         # Find the PID
         i = html.find('PASTA Identifier:')
@@ -47,9 +131,13 @@ def doi2pid(doi: str):
         return UNRESOLVED
 
 
-def pid_url(oid):
+async def pid_url(oid, scheduler: RequestScheduler, landing_pages: bool = False):
     """ Get the PID URL corresponding to a DOI. """
-    pid = doi2pid(oid)
+    if not landing_pages:
+        pid = await redirect_pid(oid, scheduler)
+        if pid:
+            return pid
+    pid = await doi2pid(oid, scheduler)
     # What we get from the DOI landing page is the PASTA Identifier. We need to massage that.
     i = pid.find(PASTA_DOMAIN)
     if i >= 0:
@@ -70,73 +158,78 @@ def read_doi_to_pid_map(mapping_filename: str):
             doi_lookup[doi] = pid
 
 
-def main(input_filename: str, output_filename: str, tsv_file_name: str):
+async def resolve_dois(dois: Iterable[str], scheduler_settings: Scheduler_settings,
+                       response_cache: ResponseCache, landing_pages: bool):
+    """
+    Resolve the DOIs into the doi_lookup table, each as soon as its landing page
+    arrives. Up to concurrency requests are kept in flight, and the request rate
+    to each host is limited.
+    """
+    count = 0
 
-    unresolved_dois = set()
+    async def resolve_and_count(doi: str):
+        nonlocal count
+        doi_lookup[doi] = await pid_url(doi, scheduler, landing_pages)
+        print('{} resolves to {}'.format(doi, doi_lookup[doi]), flush=True)
+        count += 1
+        if count % 100 == 0:   # Just so we can see signs of life...
+            print('count = {}, time = {}'.format(count, datetime.now().strftime("%H:%M:%S")), flush=True)
 
-    _doi = 0
-    _obsoletes = 1
-    _obsoletedBy = 2
-    _metadataPID = 3
-    _metadataObsoletesPID = 4
-    _metadataObsoletedByPID = 5
+    async with RequestScheduler(scheduler_settings, response_cache) as scheduler:
+        await scheduler.run(resolve_and_count, dois)
+
+
+def main(input_filename: str, output_filename: str, tsv_file_name: str,
+         scheduler_settings: Scheduler_settings, cache: str, cache_ttl: float, doi_store: str,
+         landing_pages: bool):
+    unresolved_dois = set()
 
     if tsv_file_name:
         read_doi_to_pid_map(tsv_file_name)
 
-    rows = []
-    # Read in the input CSV file
-    with open(input_filename, 'r') as input_file:
-        csvreader = csv.reader(input_file, delimiter=',')
-        # skip the header
-        next(csvreader)
-        rows = [row for row in csvreader]
-
-    # Collect all the unresolved dois    
-    for doi_record in rows:
-        if not doi_record:
-            continue
-        if doi_record[_metadataPID] == UNRESOLVED:
-            unresolved_dois.add(doi_record[_doi])
-        if doi_record[_metadataObsoletesPID] == UNRESOLVED:
-            unresolved_dois.add(doi_record[_obsoletes])
-        if doi_record[_metadataObsoletedByPID] == UNRESOLVED:
-            unresolved_dois.add(doi_record[_obsoletedBy])
+    # Collect all the unresolved dois, keeping the records to fill in the resolved pids    
+    with stop_on_chains_file_error():
+        doi_records = list(read_chains(input_filename, resolved=False))
+    for doi_record in doi_records:
+        if doi_record.metadataPID == UNRESOLVED:
+            unresolved_dois.add(doi_record.doi)
+        if doi_record.metadataObsoletesPID == UNRESOLVED:
+            unresolved_dois.add(doi_record.obsoletes)
+        if doi_record.metadataObsoletedByPID == UNRESOLVED:
+            unresolved_dois.add(doi_record.obsoletedBy)
 
     # Resolve via mapping file, if possible
     for doi, pid in doi_lookup.items():
         if doi in unresolved_dois:
             unresolved_dois.remove(doi)
 
-    # Resolve the unresolved dois
-    for doi in unresolved_dois:
-        doi_lookup[doi] = pid_url(doi)
-        print('{} resolves to {}'.format(doi, doi_lookup[doi]), flush=True)
+    # Resolve via the DOI to PID store, if possible
+    store = DOI_PID_store(doi_store)
+    stored = store.lookup_many(unresolved_dois)
+    print('{} of {} unresolved DOIs found in {}'.format(len(stored), len(unresolved_dois), doi_store), 
+          flush=True)
+    doi_lookup.update(stored)
+    unresolved_dois.difference_update(stored)
 
-    # Fill in the resolved pids
-    for doi_record in rows:
-        if not doi_record:
-            continue
-        if doi_record[_metadataPID] == UNRESOLVED:
-            doi_record[_metadataPID] = doi_lookup[doi_record[_doi]]
-        if doi_record[_metadataObsoletesPID] == UNRESOLVED:
-            doi_record[_metadataObsoletesPID] = doi_lookup[doi_record[_obsoletes]]
-        if doi_record[_metadataObsoletedByPID] == UNRESOLVED:
-            doi_record[_metadataObsoletedByPID] = doi_lookup[doi_record[_obsoletedBy]]
-
-    # Now write the output
+    # Resolve the unresolved dois
+    response_cache = ResponseCache(cache, cache_ttl) if cache else None
+    asyncio.run(resolve_dois(unresolved_dois, scheduler_settings, response_cache, landing_pages))
+    if response_cache:
+        response_cache.close()
+    store.save_many((doi, doi_lookup[doi]) for doi in unresolved_dois 
+                    if PASTA_DOMAIN in doi_lookup[doi])
+    store.close()
+
+    # Now write the output, filling in the resolved pids
     with open(output_filename, 'w') as output_file:
-        columns = [
-            'doi', 
-            'obsoletes', 
-            'obsoletedBy', 
-            'metadataPID', 
-            'metadataObsoletesPID', 
-            'metadataObsoletedByPID']
-        output_file.write('{}\n'.format(','.join(columns)))
-        for doi_record in rows:
-            if not doi_record:
-                continue
+        output_file.write('{}\n'.format(','.join(COLUMNS)))
+        for doi_record in doi_records:
+            if doi_record.metadataPID == UNRESOLVED:
+                doi_record = doi_record._replace(metadataPID=doi_lookup[doi_record.doi])
+            if doi_record.metadataObsoletesPID == UNRESOLVED:
+                doi_record = doi_record._replace(metadataObsoletesPID=doi_lookup[doi_record.obsoletes])
+            if doi_record.metadataObsoletedByPID == UNRESOLVED:
+                doi_record = doi_record._replace(metadataObsoletedByPID=doi_lookup[doi_record.obsoletedBy])
             output_file.write('{}\n'.format(','.join(doi_record)))
 
 
@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Extraction of the identifier, obsoletes and obsoletedBy fields from DataONE
+system metadata, for the scripts that read thousands of system metadata
+documents just to compare those three fields.
+
+The system metadata the nodes return is plain machine-generated XML, so
+the fields are normally picked out of the raw text with a regular
+expression, without building an element tree. Anything the scan can't be
+sure of, such as comments, CDATA sections, a DTD, a default namespace,
+unknown entities, or a field tag it can't match as a whole element, sends
+the document to an XML parser instead. The parser hands its events to a
+target that keeps only the fields, and stops at the first element that
+follows obsoletedBy in schema order. lxml is used for that if it is
+installed; otherwise the standard library's expat-based parser is used.
+
+Either way the values are those of the first identifier, obsoletes and
+obsoletedBy children of the root element, as ElementTree would give them.
+(The system metadata schema has no other elements by those names.)
+
+The obsoletes and obsoletedBy elements can be set the same way, by
+patching the raw text: values are replaced in place, elements are removed
+along with the whitespace before them, and new elements are inserted where
+the schema puts them, indented like their neighbors. The rest of the
+document, including its namespace prefixes and formatting, is left as is.
+Documents the scan can't be sure of are left for the caller to rewrite with
+an XML parser.
+"""
+
+import collections
+import re
+from typing import Union
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+
+FIELDS = ('identifier', 'obsoletes', 'obsoletedBy')
+OBSOLESCENCE_FIELDS = ('obsoletes', 'obsoletedBy')
+
+# Children of the systemMetadata element that come after obsoletedBy in schema order
+AFTER_FIELDS = {
+    'archived', 'dateUploaded', 'dateSysMetadataModified', 'originMemberNode',
+    'authoritativeMemberNode', 'replica', 'seriesId', 'mediaType', 'fileName'
+}
+
+FIELD_ELEMENTS = {
+    field: re.compile(r'<{0}(?:\s[^<>]*?)?(?:/>|>([^<]*)</{0}\s*>)'.format(field)) for field in FIELDS
+}
+TAG_NAME_ENDS = ' \t\n/>'
+AFTER_FIELDS_START = re.compile(r'<(?:{})[ \t\n/>]'.format('|'.join(sorted(AFTER_FIELDS))))
+SERIAL_VERSION = re.compile(r'<serialVersion>\s*([0-9]+)\s*</serialVersion>')
+# Constructs the scan doesn't handle: comments, CDATA, DTDs, default namespaces, carriage returns
+UNSCANNABLE = ('<!', 'xmlns=', 'xmlns ', '\r')
+ENCODING_DECLARATION = re.compile(rb'\s*<\?xml[^>]*encoding\s*=\s*["\']([A-Za-z0-9._-]+)')
+SCANNABLE_ENCODINGS = {b'utf-8', b'utf8', b'us-ascii', b'ascii'}
+REFERENCE = re.compile(r'&(#x[0-9A-Fa-f]+|#[0-9]+|amp|lt|gt|quot|apos);')
+PREDEFINED_ENTITIES = {'amp': '&', 'lt': '<', 'gt': '>', 'quot': '"', 'apos': "'"}
+
+Sysmeta_fields = collections.namedtuple('Sysmeta_fields', FIELDS)
+
+
+class _Unscannable(Exception):
+    """ Raised when a document needs a real XML parser. """
+
+
+class _Done(Exception):
+    """ Raised by the parser target to stop parsing once the fields are behind us. """
+
+
+def resolve_reference(match) -> str:
+    name = match.group(1)
+    if name.startswith('#x'):
+        return chr(int(name[2:], 16))
+    if name.startswith('#'):
+        return chr(int(name[1:]))
+    return PREDEFINED_ENTITIES[name]
+
+
+def unescape(text: str) -> str:
+    if '&' not in text:
+        return text
+    unescaped = REFERENCE.sub(resolve_reference, text)
+    if '&' in REFERENCE.sub('', text):
+        # An entity that's neither predefined nor a character reference
+        raise _Unscannable
+    return unescaped
+
+
+def scan_fields(metadata: Union[str, bytes]) -> dict:
+    """
+    Pick the fields out of the raw metadata. Raises _Unscannable if the
+    document has anything that might make the result differ from a parser's.
+    """
+    if isinstance(metadata, bytes):
+        declaration = ENCODING_DECLARATION.match(metadata)
+        if declaration and declaration.group(1).lower() not in SCANNABLE_ENCODINGS:
+            raise _Unscannable
+        try:
+            metadata = metadata.decode('utf-8')
+        except UnicodeDecodeError:
+            raise _Unscannable
+    for construct in UNSCANNABLE:
+        if construct in metadata:
+            raise _Unscannable
+    values = {}
+    for field in FIELDS:
+        start_tag = '<' + field
+        position = metadata.find(start_tag)
+        while position >= 0:
+            end = position + len(start_tag)
+            if end < len(metadata) and metadata[end] in TAG_NAME_ENDS:
+                match = FIELD_ELEMENTS[field].match(metadata, position)
+                if not match:
+                    # A field tag that isn't a simple element, e.g., one with child elements
+                    raise _Unscannable
+                if field not in values:
+                    values[field] = unescape(match.group(1) or '')
+            position = metadata.find(start_tag, end)
+    return values
+
+
+class Fields_target:
+    """
+    Parser target collecting the text of the first occurrence of each field
+    among the children of the root element.
+    """
+
+    def __init__(self):
+        self.depth = 0
+        self.values = {}
+        self.field = None
+        self.text = []
+        self.child = False
+
+    def start(self, tag, attrib):
+        self.depth += 1
+        if self.depth == 2:
+            if tag in AFTER_FIELDS:
+                raise _Done
+            if tag in FIELDS and tag not in self.values:
+                self.field = tag
+                self.text = []
+                self.child = False
+        elif self.depth == 3:
+            self.child = True
+
+    def end(self, tag):
+        if self.depth == 2 and self.field:
+            self.values[self.field] = ''.join(self.text)
+            self.field = None
+        self.depth -= 1
+
+    def data(self, data):
+        # Only the text before any child element, like ElementTree's .text
+        if self.field and self.depth == 2 and not self.child:
+            self.text.append(data)
+
+    def close(self):
+        return self.values
+
+
+def parse_fields(metadata: Union[str, bytes]) -> dict:
+    """ Pick the fields out of the metadata with an XML parser. """
+    target = Fields_target()
+    if lxml_etree is not None and isinstance(metadata, bytes):
+        parser = lxml_etree.XMLParser(target=target, no_network=True)
+    else:
+        parser = ET.XMLParser(target=target)
+    try:
+        parser.feed(metadata)
+        parser.close()
+    except _Done:
+        pass
+    return target.values
+
+
+def extract_serial_version(metadata: str) -> str:
+    """ The serialVersion of the system metadata, or None. """
+    serial_version = SERIAL_VERSION.search(metadata)
+    return serial_version.group(1) if serial_version else None
+
+
+def find_element(metadata: str, field: str):
+    """
+    The match of the field's only element in the metadata, or None if it has
+    none. Raises _Unscannable if it has more than one, or one that isn't a
+    simple element.
+    """
+    start_tag = '<' + field
+    found = None
+    position = metadata.find(start_tag)
+    while position >= 0:
+        end = position + len(start_tag)
+        if end < len(metadata) and metadata[end] in TAG_NAME_ENDS:
+            match = FIELD_ELEMENTS[field].match(metadata, position)
+            if not match or found:
+                raise _Unscannable
+            found = match
+        position = metadata.find(start_tag, end)
+    return found
+
+
+def whitespace_before(metadata: str, position: int) -> int:
+    """ The start of the run of whitespace that ends at position. """
+    while position > 0 and metadata[position - 1].isspace():
+        position -= 1
+    return position
+
+
+def obsolescence_edits(metadata: str, elements: dict, values: dict, anchor: int) -> list:
+    """
+    The (start, end, replacement) edits that give the obsoletes and obsoletedBy
+    elements the values, in the order they are to be made at any one position.
+    """
+    kept = {field: elements[field] and values[field] for field in OBSOLESCENCE_FIELDS}
+    edits = []
+    for field in OBSOLESCENCE_FIELDS:
+        element = elements[field]
+        value = values[field]
+        new_element = '<{0}>{1}</{0}>'.format(field, escape(value))
+        if element and not value:
+            edits.append((whitespace_before(metadata, element.start()), element.end(), ''))
+        elif element:
+            if unescape(element.group(1) or '') != value:
+                edits.append((element.start(), element.end(), new_element))
+        elif value:
+            if field == 'obsoletes' and kept['obsoletedBy']:
+                position = elements['obsoletedBy'].start()
+                edits.append((position, position,
+                              new_element + metadata[whitespace_before(metadata, position):position]))
+            elif field == 'obsoletedBy' and kept['obsoletes']:
+                position = elements['obsoletes'].end()
+                start = elements['obsoletes'].start()
+                edits.append((position, position,
+                              metadata[whitespace_before(metadata, start):start] + new_element))
+            else:
+                edits.append((anchor, anchor,
+                              new_element + metadata[whitespace_before(metadata, anchor):anchor]))
+    return edits
+
+
+def patch_fields(metadata: str, obsoletes: str, obsoletedBy: str) -> str:
+    """
+    Returns the system metadata with its obsoletes and obsoletedBy elements
+    set to the given values, or removed for empty values, changing only those
+    elements. Returns None if the document can't be patched safely, in which
+    case it should be rewritten with an XML parser.
+    """
+    for construct in UNSCANNABLE:
+        if construct in metadata:
+            return None
+    try:
+        elements = {field: find_element(metadata, field) for field in OBSOLESCENCE_FIELDS}
+    except _Unscannable:
+        return None
+    after_fields = AFTER_FIELDS_START.search(metadata)
+    if not after_fields:
+        return None
+    anchor = after_fields.start()
+    if any(element and element.end() > anchor for element in elements.values()):
+        # Not in schema order
+        return None
+
+    values = {'obsoletes': obsoletes or '', 'obsoletedBy': obsoletedBy or ''}
+    try:
+        edits = obsolescence_edits(metadata, elements, values, anchor)
+    except _Unscannable:
+        return None
+
+    edits.sort(key=lambda edit: edit[0])
+    pieces = []
+    position = 0
+    for start, end, replacement in edits:
+        pieces.append(metadata[position:start])
+        pieces.append(replacement)
+        position = end
+    pieces.append(metadata[position:])
+    return ''.join(pieces)
+
+
+def extract_fields(metadata: Union[str, bytes]) -> Sysmeta_fields:
+    """
+    Returns the identifier, obsoletes and obsoletedBy values in the system
+    metadata, given as text or bytes, with None for fields that are absent and
+    '' for empty ones. Raises a parse error, like ET.fromstring, if the
+    metadata has to be parsed and isn't well-formed.
+    """
+    try:
+        values = scan_fields(metadata)
+    except _Unscannable:
+        values = parse_fields(metadata)
+    return Sysmeta_fields(*[values.get(field) for field in FIELDS])
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Fingerprints of system metadata whose obsolescence information has been
+verified, so that repeat runs of update_obsolescence_chains.py and
+check_metadata_obsolescence_entries.py only look at the objects that have
+changed since.
+
+A fingerprint is the serialVersion and dateSysMetadataModified of an
+object's system metadata, the obsoletes and obsoletedBy values it was found
+to have, and the time the run that verified them started. An object is
+skipped if its expected obsoletes and obsoletedBy values are the ones in its
+fingerprint and its system metadata hasn't been modified since it was
+verified. The modified objects are found with the member node's listObjects
+API, which lists the objects of the EML formats whose system metadata was
+modified since the newest verification time of the fingerprints. The objects
+verified before then, and all of them if the listing fails, have their
+serialVersion and dateSysMetadataModified compared with their fingerprint's
+instead, using describe (HEAD) requests, which have no body to download or
+parse.
+
+The fingerprints are kept in a SQLite database keyed by PID.
+"""
+
+import collections
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+import re
+import sqlite3
+import sys
+from typing import Dict, Iterable, Set, Tuple
+import urllib.parse
+
+import click
+
+from list_ore_dois import list_objects
+from obsolescence_sources import METADATA_PID_PREFIX
+from request_scheduler import RequestScheduler
+from sysmeta_fields import extract_serial_version
+
+
+# The formats of the metadata objects whose system metadata is fingerprinted
+METADATA_FORMAT_IDS = (
+    'eml://ecoinformatics.org/eml-2.0.0',
+    'eml://ecoinformatics.org/eml-2.0.1',
+    'eml://ecoinformatics.org/eml-2.1.0',
+    'eml://ecoinformatics.org/eml-2.1.1',
+    'https://eml.ecoinformatics.org/eml-2.2.0',
+)
+# SQLite limits the number of parameters in a query
+LOOKUP_BATCH = 500
+DATE_SYSMETA_MODIFIED = re.compile(r'<dateSysMetadataModified>\s*([^<\s]+)\s*</dateSysMetadataModified>')
+FRACTION = re.compile(r'\.\d+')
+
+Fingerprint = collections.namedtuple(
+    'Fingerprint', 'serialVersion dateSysMetadataModified obsoletes obsoletedBy verified')
+
+
+def fingerprint_store_option(f):
+    """
+    Decorator adding the --fingerprints option to a click command.
+    The command function receives it as the `fingerprints` argument.
+    """
+    return click.option(
+        "--fingerprints",
+        default=None,
+        help="SQLite file of the fingerprints of the system metadata verified by earlier runs. "
+             "Objects whose system metadata hasn't changed since are skipped."
+    )(f)
+
+
+def run_started() -> str:
+    """
+    The time to record as the verification time of the fingerprints saved by a
+    run starting now, allowing a minute of slack for the member node's clock.
+    """
+    return (datetime.now(timezone.utc) - timedelta(minutes=1)).strftime('%Y-%m-%dT%H:%M:%S.000+00:00')
+
+
+def fingerprint(metadata: str, obsoletes: str, obsoletedBy: str, verified: str) -> Fingerprint:
+    """
+    The fingerprint of system metadata found to have the given obsoletes and
+    obsoletedBy values, or None if it has no serialVersion.
+    """
+    serial_version = extract_serial_version(metadata)
+    if not serial_version:
+        return None
+    date_modified = DATE_SYSMETA_MODIFIED.search(metadata)
+    return Fingerprint(
+        serial_version,
+        date_modified.group(1) if date_modified else None,
+        obsoletes or '',
+        obsoletedBy or '',
+        verified)
+
+
+class Fingerprint_store:
+    """ Fingerprints of verified system metadata keyed by PID. """
+
+    def __init__(self, path: str):
+        self.connection = sqlite3.connect(path, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS fingerprint (pid TEXT PRIMARY KEY, serialVersion TEXT, '
+            'dateSysMetadataModified TEXT, obsoletes TEXT, obsoletedBy TEXT, verified TEXT)')
+
+    def close(self):
+        self.connection.close()
+
+    def lookup_many(self, pids: Iterable[str]) -> Dict[str, Fingerprint]:
+        """ Returns the fingerprints of those of the PIDs that are in the store. """
+        pids = list(pids)
+        fingerprints = {}
+        for start in range(0, len(pids), LOOKUP_BATCH):
+            batch = pids[start:start + LOOKUP_BATCH]
+            for pid, *values in self.connection.execute(
+                    'SELECT * FROM fingerprint WHERE pid IN ({})'.format(','.join('?' * len(batch))),
+                    batch):
+                fingerprints[pid] = Fingerprint(*values)
+        return fingerprints
+
+    def save_many(self, fingerprints: Iterable[Tuple[str, Fingerprint]]):
+        """ Save (PID, fingerprint) pairs in a single transaction. """
+        with self.connection:
+            self.connection.execute('BEGIN')
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO fingerprint VALUES (?, ?, ?, ?, ?, ?)',
+                ((pid,) + tuple(fingerprint) for pid, fingerprint in fingerprints))
+
+    def touch_many(self, pids: Iterable[str], verified: str):
+        """ Record that the PIDs' fingerprints were still current at the verified time. """
+        with self.connection:
+            self.connection.execute('BEGIN')
+            self.connection.executemany(
+                'UPDATE fingerprint SET verified = ? WHERE pid = ?', ((verified, pid) for pid in pids))
+
+    def forget_many(self, pids: Iterable[str]):
+        with self.connection:
+            self.connection.execute('BEGIN')
+            self.connection.executemany('DELETE FROM fingerprint WHERE pid = ?', ((pid,) for pid in pids))
+
+
+def utc(time: datetime) -> datetime:
+    return time.replace(tzinfo=timezone.utc) if time.tzinfo is None else time
+
+
+def same_time(last_modified: str, date_modified: str) -> bool:
+    """
+    Whether a describe response's Last-Modified header, which has a resolution
+    of a second, is the time of a fingerprint's dateSysMetadataModified.
+    """
+    try:
+        described = parsedate_to_datetime(last_modified)
+        fingerprinted = datetime.fromisoformat(FRACTION.sub('', date_modified.replace('Z', '+00:00')))
+    except (TypeError, ValueError):
+        return False
+    return utc(described) == utc(fingerprinted)
+
+
+async def describe_sysmeta(mn: str, pid: str, scheduler: RequestScheduler) -> Tuple[str, str]:
+    """
+    The serialVersion and Last-Modified time of the object's system metadata,
+    from a describe request.
+    """
+    object_url = 'https://{}/mn/v2/object/{}'.format(mn, urllib.parse.quote_plus(pid))
+
+    async def describe():
+        async with scheduler.request('HEAD', object_url) as resp:
+            resp.raise_for_status()
+            return resp.headers.get('DataONE-SerialVersion'), resp.headers.get('Last-Modified')
+
+    return await scheduler.retry(describe, 'describing ' + pid)
+
+
+async def modified_since(mn: str, since: str, scheduler: RequestScheduler) -> Set[str]:
+    """ The metadata PIDs whose system metadata was modified since the given time. """
+    modified = set()
+    for format_id in METADATA_FORMAT_IDS:
+        modified.update([pid async for pid in list_objects(mn, scheduler, METADATA_PID_PREFIX,
+                                                           since, format_id)])
+    return modified
+
+
+async def unchanged_pids(mn: str, expected: Dict[str, Tuple[str, str]], store: Fingerprint_store,
+                         scheduler: RequestScheduler) -> Set[str]:
+    """
+    Returns the PIDs whose fingerprints have the expected (obsoletes, obsoletedBy)
+    values and whose system metadata hasn't been modified since it was verified.
+    """
+    candidates = {
+        pid: fingerprint for pid, fingerprint in store.lookup_many(expected).items()
+        if (fingerprint.obsoletes, fingerprint.obsoletedBy) == expected[pid]
+    }
+    if not candidates:
+        return set()
+
+    # A listing only tells about the fingerprints verified at or before its start, so it
+    # starts at the newest verification, and the fingerprints verified earlier are described
+    since = max(fingerprint.verified for fingerprint in candidates.values())
+    unchanged = set()
+    to_describe = [pid for pid, fingerprint in candidates.items() if fingerprint.verified != since]
+    try:
+        modified = await modified_since(mn, since, scheduler)
+        print('{} metadata objects modified since {}'.format(len(modified), since), flush=True)
+        unchanged.update(pid for pid, fingerprint in candidates.items()
+                         if fingerprint.verified == since and pid not in modified)
+    except:
+        print('Exception: ', sys.exc_info()[0], flush=True)
+        print('Could not list the objects modified since {}. Describing them instead.'.format(
+            since), flush=True)
+        to_describe = list(candidates)
+
+    async def describe_and_compare(pid: str):
+        try:
+            serial_version, last_modified = await describe_sysmeta(mn, pid, scheduler)
+        except:
+            # The object will be checked the long way
+            return
+        fingerprint = candidates[pid]
+        if serial_version != fingerprint.serialVersion:
+            return
+        if last_modified and fingerprint.dateSysMetadataModified and \
+                not same_time(last_modified, fingerprint.dateSysMetadataModified):
+            return
+        unchanged.add(pid)
+
+    if to_describe:
+        print('Describing {} objects'.format(len(to_describe)), flush=True)
+        await scheduler.run(describe_and_compare, to_describe)
+    return unchanged
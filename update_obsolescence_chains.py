@@ -2,21 +2,46 @@
 # -*- coding: utf-8 -*-
 
 import collections
+from concurrent.futures import ProcessPoolExecutor
 import csv
 from datetime import datetime
 from enum import Enum
+import gzip
+import io
+import os
 import sys
-import time
-from typing import List
+from typing import Dict, List
 import urllib.parse
 
-from aiohttp import ClientSession
+from aiohttp import FormData
 import asyncio
 import click
 from namedlist import namedlist
-from requests import Request, Session
 import xml.etree.ElementTree as ET
 
+try:
+    from compression import zstd
+except ImportError:
+    try:
+        import zstandard as zstd
+    except ImportError:
+        zstd = None
+
+from chains_csv import COLUMNS, Chain_record, read_chains, stop_on_chains_file_error
+from http_cache import ResponseCache, cache_options
+from request_scheduler import RequestScheduler, Scheduler_settings, TokenBucket, scheduler_options
+from sysmeta_fields import extract_fields, extract_serial_version, patch_fields
+from sysmeta_fingerprints import Fingerprint_store, fingerprint, fingerprint_store_option, run_started, \
+    unchanged_pids
+
+
+UPDATES_IN_FLIGHT = 5
+UPDATE_RATE = 5.0
+# The cores available to this process
+WORKERS = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+# Records that may be finished ahead of the next one to be written to the output TSV file
+PENDING_RECORDS = 1000
+
 
 @click.command()
 @click.argument("obsolescence_chains_csv_file")
@@ -31,10 +56,59 @@ import xml.etree.ElementTree as ET
 @click.option(
     "-o",
     default=None,
-    help="output TSV file of PIDs and url-encoded metadata for updates made",
+    help="output TSV file of PIDs and url-encoded metadata for updates made, "
+         "gzip- or zstd-compressed if its name ends in .gz or .zst. Not written with --plan",
+)
+@scheduler_options(concurrency=25, rate=25.0)
+@click.option(
+    "--updates-in-flight",
+    default=UPDATES_IN_FLIGHT,
+    help="max number of updateSysMetadata requests in flight at once. "
+         "default: {}".format(UPDATES_IN_FLIGHT),
+)
+@click.option(
+    "--update-rate",
+    default=UPDATE_RATE,
+    help="max updateSysMetadata requests per second, 0 for no limit. "
+         "default: {}".format(UPDATE_RATE),
+)
+@click.option(
+    "--workers",
+    default=WORKERS,
+    help="number of processes working out the metadata changes, 1 to work them out in this "
+         "process. default: the number of cores available ({})".format(WORKERS),
+)
+@click.option(
+    "--plan",
+    default=None,
+    help="output TSV file of the updates needed. No updates are made.",
+)
+@click.option(
+    "--apply",
+    default=False,
+    is_flag=True,
+    help="make the updates in the plan file given as OBSOLESCENCE_CHAINS_CSV_FILE",
+)
+@click.option(
+    "--resume",
+    default=False,
+    is_flag=True,
+    help="resume an interrupted run, skipping the PIDs its journal file lists as updated or "
+         "as needing no update",
+)
+@click.option(
+    "--updated",
+    default=None,
+    help="output CSV file of the obsolescence chains records of the PIDs whose metadata was "
+         "updated, for check_metadata_obsolescence_entries.py --verify",
 )
+@cache_options
+@fingerprint_store_option
 def update_obsolescence_chains(
-    obsolescence_chains_csv_file: str, client_certificate_path: str, m: str, n: str, o: str
+    obsolescence_chains_csv_file: str, client_certificate_path: str, m: str, n: str, o: str,
+    scheduler_settings: Scheduler_settings, updates_in_flight: int, update_rate: float,
+    workers: int, plan: str, apply: bool, resume: bool, updated: str, cache: str, cache_ttl: float,
+    fingerprints: str
 ):
     """
     Update obsolescence chains in eml system metadata for data packages
@@ -47,6 +121,41 @@ Arguments: \n
         OBSOLESCENCE_CHAINS_CSV_FILE (input): obsolescence chains as output
         by get_obsolescence_chains.py and resolve_unresolved_dois.py
         CLIENT_CERT_PATH (input): path to the X.509 client certificate 
+
+        The updates are sent concurrently, with up to --updates-in-flight of them
+        in flight and at most --update-rate of them started per second. They
+        share the connections used to get the metadata. The changes to the
+        metadata are worked out beforehand by a pool of --workers processes, one
+        per core available unless --workers says otherwise, or, with --workers 1,
+        in this process.
+
+        With --plan PLAN_FILE, the updates are worked out but not made. Instead,
+        PLAN_FILE lists, for each PID whose metadata needs updating, the action
+        for each field (ADD, REPLACE or REMOVE), the expected values and the
+        serialVersion of the metadata the actions were worked out from. Running
+        with --apply and PLAN_FILE in place of OBSOLESCENCE_CHAINS_CSV_FILE makes
+        just those updates, getting metadata only for the PIDs in the plan. PIDs
+        whose serialVersion has changed since the plan was made are skipped, unless
+        the plan has no serialVersion for them.
+
+        With --fingerprints, the fingerprints of the metadata found to be correct
+        are saved in the given file, and later runs skip the PIDs whose metadata
+        hasn't changed since.
+
+        As PIDs are processed, the outcome for each is appended to a journal file,
+        OBSOLESCENCE_CHAINS_CSV_FILE.updates.journal: whether its metadata needed
+        no update, or the update was attempted, and then confirmed or failed,
+        with the HTTP status code. If the run is interrupted, or some updates
+        fail, rerun it with --resume to process only the PIDs whose updates
+        weren't confirmed, appending to the output TSV file. The journal is
+        removed once all the updates are made.
+
+        With --updated UPDATED_CSV_FILE, the records of the PIDs whose metadata
+        updates were sent, with the values they were expected to get, are saved
+        in UPDATED_CSV_FILE, in the form of OBSOLESCENCE_CHAINS_CSV_FILE, along with
+        those of the PIDs whose metadata couldn't be fetched or fixed up. Running
+        check_metadata_obsolescence_entries.py with --verify UPDATED_CSV_FILE
+        then checks just those PIDs.
     """
 
     # Check the Python version
@@ -54,24 +163,28 @@ Arguments: \n
         print("Requires Python 3.7 or later")
         exit(0)
 
-    main(obsolescence_chains_csv_file, client_certificate_path, m, int(n), o)
+    if plan and apply:
+        print("--plan and --apply can't be used together")
+        exit(1)
 
+    main(obsolescence_chains_csv_file, client_certificate_path, m, int(n), o, scheduler_settings,
+         updates_in_flight, update_rate, workers, plan, apply, resume, updated, cache, cache_ttl,
+         fingerprints)
 
-UNRESOLVED = "UNRESOLVED"
-MAX_RETRIES = 3
+
+# Stands in for the metadata of PIDs skipped because it hasn't changed since it was verified
+UNCHANGED = "UNCHANGED"
+# Stands in for the metadata of PIDs skipped because the journal of an earlier run has them as done
+RESUMED = "RESUMED"
 
 
 metadata_records = collections.OrderedDict()
 Metadata_record = namedlist(
     'Metadata_record',
-    'pid obsoletes_status obsoletedBy_status metadata original_metadata',
+    'pid obsoletes_status obsoletedBy_status metadata original_metadata serialVersion fingerprint',
     default=None)
 
 doi_records = collections.OrderedDict()
-DOI_record = namedlist(
-    'DOI_record', 
-    'doi obsoletes obsoletedBy metadataPID metadataObsoletesPID metadataObsoletedByPID',
-    default=None)
 
 
 class Tag_Status(Enum):
@@ -82,48 +195,49 @@ class Tag_Status(Enum):
     REMOVE = 4
 
 
-async def get_metadata(mn: str, pid: str, session: ClientSession, **kwargs) -> str:
+PLAN_COLUMNS = ['pid', 'obsoletes', 'obsoletedBy', 'expectedObsoletes', 'expectedObsoletedBy',
+                'serialVersion']
+
+# serialVersion of each PID's metadata when the plan being applied was made, keyed by PID
+planned_serial_versions = {}
+
+# Outcomes recorded in the journal file, whose rows are: pid, obsoletes and obsoletedBy
+# actions, outcome, HTTP status code
+NO_UPDATE = 'OK'
+SKIPPED = 'SKIPPED'
+ATTEMPTED = 'ATTEMPTED'
+CONFIRMED = 'CONFIRMED'
+FAILED = 'FAILED'
+# Outcomes of PIDs that don't need to be processed again
+DONE = (NO_UPDATE, SKIPPED, CONFIRMED)
+
+
+def metadata_url(mn: str, pid: str) -> str:
+    return 'https://{}/mn/v2/meta/{}'.format(mn, urllib.parse.quote_plus(pid))
+
+
+async def get_metadata(mn: str, pid: str, scheduler: RequestScheduler, **kwargs) -> str:
     """
     Retrieve system metadata for a package. This is the metadata to which obsolescence
     information may need to be added. Return the response text (the metadata).
     """
-    metadata_url = 'https://{}/mn/v2/meta/{}'.format(mn, urllib.parse.quote_plus(pid))
-    resp = await session.request(method='GET', url=metadata_url, **kwargs)
-    resp.raise_for_status()
-    return await resp.text()
+    return await scheduler.get_text(metadata_url(mn, pid), **kwargs)
 
 
-async def save_metadata(mn: str, pid: str, session: ClientSession):
+async def save_metadata(mn: str, pid: str, scheduler: RequestScheduler):
     """
     Save the returned metadata in the metadata_records dict. Handle needed retries, if any.
     """
     global metadata_records
-    retries = 0
-    while retries < MAX_RETRIES:
-        try:
-            metadata_response = await get_metadata(mn, pid, session)
-            break  # no exception, so break out of the retry loop
-        except:
-            print('Exception: ', sys.exc_info()[0], flush=True)
-            retries += 1
-            print('retries:', retries, ' ', pid, '  getting metadata', flush=True)
-            if retries >= MAX_RETRIES:
-                print('Reached max retries getting metadata. Giving up...', flush=True)
-                return
-            time.sleep(1)
+    try:
+        metadata_response = await get_metadata(mn, pid, scheduler)
+    except:
+        print('Exception: ', sys.exc_info()[0], flush=True)
+        print('Gave up getting metadata for', pid, flush=True)
+        return
     metadata_records[pid].original_metadata = metadata_response
 
 
-async def run_get_metadata_tasks(mn: str, pids: List[str]):
-    """
-    Fire off a list of tasks to get metadata and save it in the
-    metadata_records table.
-    """
-    async with ClientSession() as session:
-        tasks = [save_metadata(mn, pid, session) for pid in pids]
-        await asyncio.gather(*tasks)
-
-
 def add_tag(root, tag, text, after_tags=None):
     """
     Adds an XML tag, placing. Returns the root of the updated element tree.
@@ -182,110 +296,57 @@ def status_text(tag_status):
 sent_count = 0
 
 
-def send_update_sys_metadata(mn: str, pid: str, metadata_xml: str, client_certificate_path: str):
+async def send_update_sys_metadata(mn: str, pid: str, metadata_xml: str, scheduler: RequestScheduler,
+                                   update_bucket: TokenBucket = None):
     """
-    Send a updateSysMetadata request to the member node.
-    This is not done asynchronously because we need to use PreparedRequest.
+    Send a updateSysMetadata request to the member node, over the scheduler's
+    connections, which present the client certificate. If update_bucket is
+    given, each try takes a token from it, limiting the rate of updates.
+    Returns the HTTP status code of the last try, which is not 200 if the
+    update failed, or None if no response was received.
     """
     print('updateSysMetadata: ', pid, flush=True)
     global sent_count
     sent_count += 1
-    session = Session()    
-    # To get a multipart request in the needed format, we need to do 
-    #   some fiddling...
     *_, scope, identifier, revision = pid.split('/')
     # We're not really going to use an xml file, but we provide a name
     #   to make log entries clearer
     sysmeta_filename = '.'.join([scope, identifier, revision]) + '.sysmeta.xml'
-    prepped_request = Request(
-        'PUT', 
-        'https://{}/mn/v2/meta'.format(mn),
-        files={
-            'pid': (None, pid),
-            'sysmeta': (sysmeta_filename, metadata_xml.encode('ascii'), 'application/xml')
-        }).prepare()
-    retries = 0
-    status_code = None
-    while retries < MAX_RETRIES:
-        try:
-            resp = session.send(prepped_request, cert=client_certificate_path)
-            if resp.status_code != 200:
-                print('{} return status code = {}'.format(sysmeta_filename, str(resp.status_code)), flush=True)
-                retries += 1
-                if retries >= MAX_RETRIES:
-                    print('Reached max retries updating metadata. Giving up...', flush=True)
-                    print(metadata_xml, flush=True)
-                    return
-                time.sleep(1)
-            else:
-                break
-        except:
-            print('Exception: ', sys.exc_info(), flush=True)
-            retries += 1
-            print('retries:', retries, ' ', pid, '  getting metadata', flush=True)
-            if retries >= MAX_RETRIES:
-                print('Reached max retries updating metadata. Giving up...', flush=True)
-                return
-            time.sleep(1)
-    return status_code
 
+    async def send():
+        # The multipart body is consumed by sending it, so each try builds its own
+        form = FormData()
+        form.add_field('pid', pid)
+        form.add_field('sysmeta', metadata_xml.encode('utf-8'),
+                       filename=sysmeta_filename, content_type='application/xml')
+        if update_bucket:
+            await update_bucket.acquire()
+        async with scheduler.request('PUT', 'https://{}/mn/v2/meta'.format(mn), data=form) as resp:
+            if resp.status != 200:
+                print('{} return status code = {}'.format(sysmeta_filename, str(resp.status)), flush=True)
+            resp.raise_for_status()
+            return resp.status
 
-def fixup_metadata_xml(mn, pid, client_certificate_path):
-    """
-    Given the current system metadata for a package and the desired
-    obsolescence information,
-       - determines if the system metadata needs to be modified
-       - if so, generates the updated system metadata and updates it
-    on the member node
-    """
-    global metadata_records
+    try:
+        return await scheduler.retry(send, 'updating metadata for ' + pid)
+    except:
+        print('Exception: ', sys.exc_info(), flush=True)
+        print('Gave up updating metadata for', pid, flush=True)
+        print(metadata_xml, flush=True)
+        return getattr(sys.exc_info()[1], 'status', None)
 
-    original_metadata = metadata_records[pid].original_metadata
-    obsoletes = doi_records[pid].metadataObsoletesPID
-    obsoletedBy = doi_records[pid].metadataObsoletedByPID
 
-    root = ET.fromstring(original_metadata)
+def update_confirmed(status_code):
+    """ Only a 200 confirms an update. A redirect, say, is journaled as failed, to be retried. """
+    return status_code == 200
 
-    # Tentative status, which may be superseded below
-    if obsoletes:
-        obsoletes_status = Tag_Status.ADD
-    else:
-        obsoletes_status = Tag_Status.OK
-    if obsoletedBy:
-        obsoletedBy_status = Tag_Status.ADD
-    else:
-        obsoletedBy_status = Tag_Status.OK
-
-    for child in root:
-
-        if child.tag == 'obsoletes':
-            obsoletes_value = child.text
-            if obsoletes:
-                if obsoletes == obsoletes_value:
-                    # obsoletes tag is present and has the desired value
-                    obsoletes_status = Tag_Status.OK
-                else:
-                    # obsoletes tag is present but the value isn't what we want
-                    obsoletes_status = Tag_Status.REPLACE
-            else:
-                # obsoletes tag is present but shouldn't be
-                obsoletes_status = Tag_Status.REMOVE
-
-        if child.tag == 'obsoletedBy':
-            obsoletedBy_value = child.text
-            if obsoletedBy:
-                if obsoletedBy == obsoletedBy_value:
-                    # obsoletedBy tag is present and has the desired value
-                    obsoletedBy_status = Tag_Status.OK
-                else:
-                    # obsoletedBy tag is present but the value isn't what
-                    # we want
-                    obsoletedBy_status = Tag_Status.REPLACE
-            else:
-                # obsoletedBy tag is present but shouldn't be
-                obsoletedBy_status = Tag_Status.REMOVE
 
-    # If needed, update the metadata
+def rewrite_metadata_xml(original_metadata, obsoletes, obsoletedBy, obsoletes_status, obsoletedBy_status):
+    """
+    Generate the updated system metadata by parsing and re-serializing it, for
+    metadata that can't be patched in place.
+    """
+    root = ET.fromstring(original_metadata)
 
     if obsoletes_status == Tag_Status.ADD:
         root = add_tag(root, 'obsoletes', obsoletes, ('replicationPolicy', 'accessPolicy'))
@@ -307,10 +368,95 @@ def fixup_metadata_xml(mn, pid, client_certificate_path):
     elif obsoletedBy_status == Tag_Status.REMOVE:
         root = remove_tag(root, 'obsoletedBy')
 
-    metadata = ET.tostring(root).decode('utf-8')
+    return ET.tostring(root).decode('utf-8')
+
+
+def field_status(expected, value):
+    """ The change needed to give a field with the value, or None if absent, the expected value. """
+    if value is None:
+        return Tag_Status.ADD if expected else Tag_Status.OK
+    if not expected:
+        # tag is present but shouldn't be
+        return Tag_Status.REMOVE
+    if expected == value:
+        # tag is present and has the desired value
+        return Tag_Status.OK
+    # tag is present but the value isn't what we want
+    return Tag_Status.REPLACE
+
 
+def compute_fixup(original_metadata, obsoletes, obsoletedBy):
+    """
+    Given the current system metadata for a package and the desired
+    obsolescence information,
+       - determines if the system metadata needs to be modified
+       - if so, generates the updated system metadata
+    The obsoletes and obsoletedBy elements are patched in the original
+    metadata, leaving the rest of it as is, unless it has to be rewritten.
+    Returns the status of each field, the updated metadata and the metadata's
+    serialVersion. This runs in a worker process, so it uses only its arguments.
+    """
+    fields = extract_fields(original_metadata)
+    serialVersion = extract_serial_version(original_metadata)
+
+    obsoletes_status = field_status(obsoletes, fields.obsoletes)
+    obsoletedBy_status = field_status(obsoletedBy, fields.obsoletedBy)
+
+    # If needed, update the metadata
+    metadata = original_metadata
     if obsoletes_status != Tag_Status.OK or obsoletedBy_status != Tag_Status.OK:
-        send_update_sys_metadata(mn, pid, metadata, client_certificate_path)
+        metadata = patch_fields(original_metadata, obsoletes, obsoletedBy)
+        if metadata is None:
+            metadata = rewrite_metadata_xml(original_metadata, obsoletes, obsoletedBy,
+                                            obsoletes_status, obsoletedBy_status)
+    return obsoletes_status, obsoletedBy_status, metadata, serialVersion
+
+
+def try_compute_fixup(pid, original_metadata, obsoletes, obsoletedBy):
+    """ compute_fixup, returning None if the metadata can't be fixed up, e.g., isn't well-formed. """
+    try:
+        return compute_fixup(original_metadata, obsoletes, obsoletedBy)
+    except:
+        print('Exception: ', sys.exc_info(), flush=True)
+        print('Gave up fixing up metadata for', pid, flush=True)
+        return None
+
+
+async def fixup_metadata_xml(mn, pid, scheduler, update_bucket=None, update=True, fixup=None,
+                             journal=None):
+    """
+    Given the current system metadata for a package and the desired
+    obsolescence information,
+       - determines if the system metadata needs to be modified, unless
+         fixup already has the result of compute_fixup
+       - if so, generates the updated system metadata and, if update is
+         True, updates it on the member node
+    The outcome is recorded in the journal, if one is given.
+    """
+    original_metadata = metadata_records[pid].original_metadata
+    if fixup is None:
+        fixup = compute_fixup(original_metadata, doi_records[pid].metadataObsoletesPID,
+                              doi_records[pid].metadataObsoletedByPID)
+    obsoletes_status, obsoletedBy_status, metadata, serialVersion = fixup
+    metadata_records[pid].serialVersion = serialVersion
+
+    if pid in planned_serial_versions and serialVersion != planned_serial_versions[pid]:
+        print('Metadata for {} has changed since the plan was made (serialVersion {}, planned {}). '
+              'Skipping.'.format(pid, serialVersion, planned_serial_versions[pid]), flush=True)
+        if journal:
+            journal.writerow([pid, '', '', SKIPPED, ''])
+        return '', '', '', original_metadata
+
+    actions = [status_text(obsoletes_status), status_text(obsoletedBy_status)]
+    if update and (obsoletes_status != Tag_Status.OK or obsoletedBy_status != Tag_Status.OK):
+        if journal:
+            journal.writerow([pid, *actions, ATTEMPTED, ''])
+        status_code = await send_update_sys_metadata(mn, pid, metadata, scheduler, update_bucket)
+        if journal:
+            journal.writerow([pid, *actions, CONFIRMED if update_confirmed(status_code) else FAILED,
+                              status_code or ''])
+    elif journal:
+        journal.writerow([pid, *actions, NO_UPDATE, ''])
 
     metadata_records[pid].obsoletes_status = obsoletes_status
     metadata_records[pid].obsoletedBy_status = obsoletedBy_status
@@ -324,85 +470,412 @@ def fixup_metadata_xml(mn, pid, client_certificate_path):
     )
 
 
-def write_output_tsv(output_tsv_file):
-    if not output_tsv_file:
-        return
-    with open(output_tsv_file, 'w') as output_tsv:
-        output_tsv.write(
-            # Write the headers
-            'pid\tobsoletes\tobsoletedBy\tmetadata\toriginal_metadata\n')
-        for pid, metadata_record in metadata_records.items():
-            output_tsv.write('{}\t{}\t{}\t{}\t{}\n'.format(
-                metadata_record.pid, 
+def open_output_tsv(output_tsv_file, append: bool = False):
+    """
+    Open the output TSV file for writing, or appending, compressed if its name
+    ends in .gz or .zst.
+    """
+    mode = 'a' if append else 'w'
+    if output_tsv_file.endswith('.gz'):
+        return gzip.open(output_tsv_file, mode + 't')
+    if output_tsv_file.endswith('.zst'):
+        if zstd is None:
+            print('zstd compression requires the zstandard package. Exiting.', flush=True)
+            exit(0)
+        if hasattr(zstd, 'open'):
+            return zstd.open(output_tsv_file, mode + 't')
+        return io.TextIOWrapper(zstd.ZstdCompressor().stream_writer(open(output_tsv_file, mode + 'b')))
+    return open(output_tsv_file, mode)
+
+
+class Output_tsv:
+    """
+    Writes the records to the output TSV file, if there is one, as soon as they
+    and the records before them have been processed, so the records keep their
+    order. Once written, a record's metadata is released. Processing can get at
+    most PENDING_RECORDS records ahead of the next one to be written.
+    """
+
+    def __init__(self, output_tsv_file, fingerprints: bool = False, append: bool = False):
+        self.output_tsv = None
+        if output_tsv_file:
+            # A resumed run adds its records to those of the run it resumes
+            append = append and os.path.exists(output_tsv_file)
+            self.output_tsv = open_output_tsv(output_tsv_file, append)
+            if not append:
+                # Write the headers
+                self.output_tsv.write('pid\tobsoletes\tobsoletedBy\tmetadata\toriginal_metadata\n')
+                self.output_tsv.flush()
+        self.fingerprints = fingerprints
+        self.finished = {}
+        self.written = 0
+        self.advanced = asyncio.Condition()
+
+    async def wait_for_room(self, index: int):
+        async with self.advanced:
+            await self.advanced.wait_for(lambda: index - self.written < PENDING_RECORDS)
+
+    async def finish(self, index: int, pid: str):
+        self.finished[index] = pid
+        while self.written in self.finished:
+            self.write(self.finished.pop(self.written))
+            self.written += 1
+        async with self.advanced:
+            self.advanced.notify_all()
+
+    def write(self, pid: str):
+        metadata_record = metadata_records[pid]
+        if metadata_record.original_metadata == RESUMED:
+            # The run that did it wrote it to the output TSV file
+            return
+        if self.output_tsv:
+            self.output_tsv.write('{}\t{}\t{}\t{}\t{}\n'.format(
+                metadata_record.pid,
                 status_text(metadata_record.obsoletes_status),
                 status_text(metadata_record.obsoletedBy_status),
                 metadata_record.metadata,
                 metadata_record.original_metadata))
+            # So a partial output file survives a crash
+            self.output_tsv.flush()
+        if self.fingerprints and metadata_record.obsoletes_status == Tag_Status.OK and \
+                metadata_record.obsoletedBy_status == Tag_Status.OK and \
+                metadata_record.original_metadata != UNCHANGED:
+            metadata_record.fingerprint = fingerprint(metadata_record.original_metadata,
+                                                      doi_records[pid].metadataObsoletesPID,
+                                                      doi_records[pid].metadataObsoletedByPID, None)
+        metadata_record.metadata = None
+        if metadata_record.original_metadata != UNCHANGED:
+            metadata_record.original_metadata = None
+
+    def close(self):
+        if self.output_tsv:
+            self.output_tsv.close()
+
+
+class Journal_writer:
+    """
+    Appends rows to the journal file, flushing each one, and keeps track of the
+    PIDs that are done.
+    """
 
+    def __init__(self, journal_file):
+        self.journal_file = journal_file
+        self.csv_writer = csv.writer(journal_file)
+        self.done = set()
 
-def main(obsolescence_chains_csv_file: str,
-         client_certificate_path: str,
-         mn: str,
-         max_n: int,
-         output_tsv_file: str):
+    def writerow(self, row):
+        self.csv_writer.writerow(row)
+        self.journal_file.flush()
+        if row[3] in DONE:
+            self.done.add(row[0])
 
-    global doi_records
-    global metadata_records
-    global sent_count
 
-    # Read in the DOI records
-    with open(obsolescence_chains_csv_file, 'r') as input_csv_file:
-        # Check for UNRESOLVED entries
-        if input_csv_file.read().find(UNRESOLVED) > -1:
-            print(
-                'UNRESOLVED DOIs found. Please run resolve_unresolved_dois.py '
-                'and use its output. Exiting.', flush=True
-            )
-            exit(0)
+def journal_filename(obsolescence_chains_csv_file: str) -> str:
+    return obsolescence_chains_csv_file + '.updates.journal'
+
+
+def read_journal(journal_filename: str) -> Dict[str, List[str]]:
+    """
+    Load the outcomes recorded by an earlier run. Returns the obsoletes and
+    obsoletedBy actions of the PIDs that needed no update, were skipped, or
+    whose update was confirmed, keyed by PID. These PIDs don't need to be
+    processed again.
+    """
+    done = {}
+    if not os.path.exists(journal_filename):
+        return done
+    with open(journal_filename, mode='r', newline='') as journal_file:
+        for row in csv.reader(journal_file):
+            # The last row may be incomplete if the run was killed while writing it
+            if len(row) != 5:
+                continue
+            pid, obsoletes_action, obsoletedBy_action, outcome, _ = row
+            if outcome in DONE:
+                done[pid] = [obsoletes_action, obsoletedBy_action]
+            else:
+                done.pop(pid, None)
+    print('{} PIDs done in {}'.format(len(done), journal_filename), flush=True)
+    return done
 
-        input_csv_file.seek(0)
-        csvreader = csv.reader(input_csv_file, delimiter=',')
-        # skip the header
-        next(csvreader)
-        for row in csvreader:
-            doi_record = DOI_record(*row)
-            if (doi_record.metadataObsoletesPID or doi_record.metadataObsoletedByPID):
-                pid = doi_record.metadataPID
-                doi_records[pid] = doi_record
-                # Initialize the metadata_records table, too, so we have rows in the same order. 
-                # This will make it easier to check and troubleshoot.
-                metadata_records[pid] = Metadata_record(pid, '', '', '', 'NA')
-
-    # Go get the metadata that needs to be modified
-    print('Getting metadata', flush=True)
+
+def tag_status(action: str) -> Tag_Status:
+    """ The Tag_Status for an action saved with status_text. """
+    return Tag_Status[action] if action else Tag_Status.OK
+
+
+async def run_update_tasks(mn: str, pids: List[str], scheduler: RequestScheduler, updates_in_flight: int,
+                           update_rate: float, response_cache: ResponseCache, output: Output_tsv,
+                           update: bool = True, workers: int = 1, journal: Journal_writer = None):
+    """
+    Get the metadata of each record in the metadata_records table, modify it as
+    needed and update it on the member node. Up to concurrency records are in
+    process at once, with up to updates_in_flight updates in flight, and at most
+    update_rate updates are started per second. If update is False, the modified
+    metadata is worked out but not sent.
+
+    If workers is more than 1, the modified metadata is worked out by a pool of
+    workers processes, without holding up the event loop. Each record is handed to output once processed,
+    and the records keep their order, whatever order they finish in. PIDs not
+    in pids are only handed to output.
+    """
     count = 0
-    pids = []
-    for _, doi_record in doi_records.items():
-        # Has obsolescence info so metadata needs to be modified
-        pids.append(doi_record.metadataPID)
-        count += 1
-        # Access the member node in bursts so we don't do a denial of service attack on it
-        if count % 25 == 0:
-            # Create tasks to get metadata
-            asyncio.run(run_get_metadata_tasks(mn, pids))
-            time.sleep(1)
-            pids = []
-        if count % 1000 == 0:   # Just so we can see signs of life...
-            print('count = {}, time = {}'.format(count, datetime.now().strftime("%H:%M:%S")), flush=True)
-    asyncio.run(run_get_metadata_tasks(mn, pids))
+    update_bucket = TokenBucket(update_rate)
+    updates = asyncio.Semaphore(max(1, updates_in_flight))
+    to_process = set(pids)
+    loop = asyncio.get_running_loop()
+    pool = ProcessPoolExecutor(workers) if workers > 1 else None
+
+    async def records():
+        for index, pid in enumerate(metadata_records):
+            await output.wait_for_room(index)
+            yield index, pid
+
+    async def compute(pid: str):
+        args = (pid, metadata_records[pid].original_metadata, doi_records[pid].metadataObsoletesPID,
+                doi_records[pid].metadataObsoletedByPID)
+        if pool:
+            return await loop.run_in_executor(pool, try_compute_fixup, *args)
+        return try_compute_fixup(*args)
+
+    async def process(pid: str):
+        await save_metadata(mn, pid, scheduler)
+        if metadata_records[pid].original_metadata == 'NA':
+            print('Unexpected Error: original_metadata not found for {}'.format(pid), flush=True)
+            return
+        fixup = await compute(pid)
+        if fixup is None:
+            return
+        async with updates:
+            obsoletes_status, obsoletedBy_status, *_ = await fixup_metadata_xml(
+                mn, pid, scheduler, update_bucket, update, fixup, journal)
+        if update and response_cache and (obsoletes_status or obsoletedBy_status):
+            # The cached metadata is now out of date
+            response_cache.invalidate(metadata_url(mn, pid))
+
+    async def process_and_count(record):
+        nonlocal count
+        index, pid = record
+        try:
+            if pid in to_process:
+                await process(pid)
+                count += 1
+                if count % 1000 == 0:   # Just so we can see signs of life...
+                    print('count = {}, time = {}'.format(count, datetime.now().strftime("%H:%M:%S")),
+                          flush=True)
+        finally:
+            await output.finish(index, pid)
+
+    try:
+        await scheduler.run(process_and_count, records())
+    finally:
+        if pool:
+            pool.shutdown()
     print('count = {}, time = {}'.format(count, datetime.now().strftime("%H:%M:%S")), flush=True)
 
-    # Now that we've got the metadata, modify it as needed and update it on the member node
-    print('Updating metadata', flush=True)
-    pids = []
+
+async def update_metadata(mn: str, pids: List[str], client_certificate_path: str,
+                          scheduler_settings: Scheduler_settings, updates_in_flight: int,
+                          update_rate: float, response_cache: ResponseCache, output: Output_tsv,
+                          update: bool = True, fingerprint_store: Fingerprint_store = None,
+                          workers: int = 1, journal: Journal_writer = None):
+    """
+    Get the metadata, modify it as needed and update it on the member node, all
+    over the same pool of connections. If a fingerprint store is given, PIDs whose
+    metadata hasn't changed since it was verified are skipped.
+    """
+    async with RequestScheduler(scheduler_settings, response_cache, client_certificate_path) as scheduler:
+        if fingerprint_store:
+            expected = {pid: (doi_records[pid].metadataObsoletesPID, doi_records[pid].metadataObsoletedByPID)
+                        for pid in pids}
+            unchanged = await unchanged_pids(mn, expected, fingerprint_store, scheduler)
+            print('{} PIDs unchanged since they were verified'.format(len(unchanged)), flush=True)
+            for pid in unchanged:
+                metadata_records[pid] = Metadata_record(pid, Tag_Status.OK, Tag_Status.OK, UNCHANGED, UNCHANGED)
+                if journal:
+                    journal.writerow([pid, '', '', NO_UPDATE, ''])
+            pids = [pid for pid in pids if pid not in unchanged]
+
+        # Get the metadata, modify it as needed and update it on the member node
+        print('Updating metadata' if update else 'Planning updates', flush=True)
+        await run_update_tasks(mn, pids, scheduler, updates_in_flight, update_rate, response_cache,
+                               output, update, workers, journal)
+
+
+def save_fingerprints(fingerprint_store: Fingerprint_store, verified: str):
+    """
+    Save the fingerprints of the metadata found to be correct, and forget those
+    of the metadata that was changed or may need to be. Only the PIDs found to be
+    unchanged in this run are touched. Those resumed from the journal, which
+    weren't looked at, keep the fingerprints they had.
+    """
+    verified_pids = []
+    fingerprints = []
+    changed_pids = []
     for pid, metadata_record in metadata_records.items():
-        if metadata_record.original_metadata == 'NA':
-            print('Unexpected Error: original_metadata not found for {}'.format(pid), flush=True)
-            continue
-        count += 1
-        fixup_metadata_xml(mn, pid, client_certificate_path)        
+        if metadata_record.obsoletes_status != Tag_Status.OK or \
+                metadata_record.obsoletedBy_status != Tag_Status.OK:
+            changed_pids.append(pid)
+        elif metadata_record.original_metadata == UNCHANGED:
+            verified_pids.append(pid)
+        elif metadata_record.fingerprint:
+            fingerprints.append((pid, metadata_record.fingerprint._replace(verified=verified)))
+    fingerprint_store.touch_many(verified_pids, verified)
+    fingerprint_store.save_many(fingerprints)
+    fingerprint_store.forget_many(changed_pids)
+
+
+def write_plan(plan_file):
+    """
+    Write the plan file: the PIDs whose metadata needs updating, the actions
+    needed, the expected values and the serialVersion of the metadata.
+    """
+    planned = 0
+    with open(plan_file, 'w', newline='') as plan_tsv:
+        plan_writer = csv.writer(plan_tsv, delimiter='\t', lineterminator='\n')
+        plan_writer.writerow(PLAN_COLUMNS)
+        for pid, metadata_record in metadata_records.items():
+            obsoletes_status = status_text(metadata_record.obsoletes_status)
+            obsoletedBy_status = status_text(metadata_record.obsoletedBy_status)
+            if not (obsoletes_status or obsoletedBy_status):
+                continue
+            plan_writer.writerow([
+                pid,
+                obsoletes_status,
+                obsoletedBy_status,
+                doi_records[pid].metadataObsoletesPID,
+                doi_records[pid].metadataObsoletedByPID,
+                metadata_record.serialVersion])
+            planned += 1
+    print('{} updates planned in {}'.format(planned, plan_file), flush=True)
+
+
+def write_updated(updated_csv_file):
+    """
+    Write the DOI records of the PIDs whose metadata updates were sent, in the
+    form of the obsolescence chains CSV file. The PIDs whose metadata couldn't be
+    fetched or fixed up, so whether they need updating isn't known, are written
+    too, so that they are checked as well.
+    """
+    updated = 0
+    unverified = 0
+    with open(updated_csv_file, 'w', newline='') as updated_csv:
+        csv_writer = csv.writer(updated_csv, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        csv_writer.writerow(COLUMNS)
+        for pid, metadata_record in metadata_records.items():
+            if metadata_record.obsoletes_status == '':
+                unverified += 1
+            elif not (status_text(metadata_record.obsoletes_status) or
+                      status_text(metadata_record.obsoletedBy_status)):
+                continue
+            csv_writer.writerow(list(doi_records[pid]))
+            updated += 1
+    print('{} updated PIDs saved in {}'.format(updated - unverified, updated_csv_file), flush=True)
+    if unverified:
+        print('{} PIDs whose metadata could not be checked saved in {} too, '
+              'as unverified'.format(unverified, updated_csv_file), flush=True)
+
+
+def read_plan(plan_file):
+    """
+    Load the plan into the doi_records and metadata_records tables, with the
+    expected values as the obsolescence information to be set.
+    """
+    if not os.path.isfile(plan_file):
+        print('{} not found. Exiting.'.format(plan_file), flush=True)
+        exit(1)
+    with open(plan_file, 'r', newline='') as plan_tsv:
+        plan_reader = csv.reader(plan_tsv, delimiter='\t')
+        if next(plan_reader, None) != PLAN_COLUMNS:
+            print('{} is not a plan file. Exiting.'.format(plan_file), flush=True)
+            exit(1)
+        for row in plan_reader:
+            if len(row) != len(PLAN_COLUMNS):
+                print('{}, line {}: {} columns found, {} expected. Exiting.'.format(
+                    plan_file, plan_reader.line_num, len(row), len(PLAN_COLUMNS)), flush=True)
+                exit(1)
+            pid, _, _, expected_obsoletes, expected_obsoletedBy, serialVersion = row
+            doi_records[pid] = Chain_record(None, None, None, pid, expected_obsoletes, expected_obsoletedBy)
+            metadata_records[pid] = Metadata_record(pid, '', '', '', 'NA')
+            # Metadata planned without a serialVersion has nothing to check it against
+            if serialVersion:
+                planned_serial_versions[pid] = serialVersion
+    print('{} updates found in {}'.format(len(doi_records), plan_file), flush=True)
+
+
+def read_obsolescence_chains(obsolescence_chains_csv_file):
+    """
+    Load the DOI records that have obsolescence information into the doi_records
+    table, keyed by metadata PID.
+    """
+    for doi_record in read_chains(obsolescence_chains_csv_file):
+        if (doi_record.metadataObsoletesPID or doi_record.metadataObsoletedByPID):
+            pid = doi_record.metadataPID
+            doi_records[pid] = doi_record
+            # Initialize the metadata_records table, too, so we have rows in the same order. 
+            # This will make it easier to check and troubleshoot.
+            metadata_records[pid] = Metadata_record(pid, '', '', '', 'NA')
 
-    write_output_tsv(output_tsv_file)
+
+def main(obsolescence_chains_csv_file: str,
+         client_certificate_path: str,
+         mn: str,
+         max_n: int,
+         output_tsv_file: str,
+         scheduler_settings: Scheduler_settings, updates_in_flight: int, update_rate: float,
+         workers: int, plan_file: str, apply: bool, resume: bool, updated_csv_file: str, cache: str,
+         cache_ttl: float, fingerprints: str = None):
+    started = run_started()
+
+    # Read in the DOI records, or the plan
+    if apply:
+        read_plan(obsolescence_chains_csv_file)
+    else:
+        with stop_on_chains_file_error():
+            read_obsolescence_chains(obsolescence_chains_csv_file)
+
+    pids = [doi_record.metadataPID for doi_record in doi_records.values()]
+    journal = journal_filename(obsolescence_chains_csv_file)
+    if resume:
+        done = read_journal(journal)
+        for pid, (obsoletes_action, obsoletedBy_action) in done.items():
+            if pid in metadata_records:
+                metadata_records[pid] = Metadata_record(pid, tag_status(obsoletes_action),
+                                                        tag_status(obsoletedBy_action), RESUMED, RESUMED)
+        pids = [pid for pid in pids if pid not in done]
+    response_cache = ResponseCache(cache, cache_ttl) if cache else None
+    fingerprint_store = Fingerprint_store(fingerprints) if fingerprints else None
+    # Plans make no updates, so the output TSV file of the updates made is left alone
+    output = Output_tsv(None if plan_file else output_tsv_file, fingerprint_store is not None, resume)
+    # Plans make no updates, so they need no journal
+    journal_file = open(journal, mode='a' if resume else 'w', newline='') if not plan_file else None
+    journal_writer = Journal_writer(journal_file) if journal_file else None
+    try:
+        asyncio.run(update_metadata(mn, pids, client_certificate_path, scheduler_settings,
+                                    updates_in_flight, update_rate, response_cache, output,
+                                    not plan_file, fingerprint_store, workers, journal_writer))
+    finally:
+        output.close()
+        if journal_file:
+            journal_file.close()
+    if response_cache:
+        response_cache.close()
+    if fingerprint_store:
+        save_fingerprints(fingerprint_store, started)
+        fingerprint_store.close()
+
+    if plan_file:
+        write_plan(plan_file)
+    elif updated_csv_file:
+        write_updated(updated_csv_file)
+
+    if journal_writer:
+        not_done = [pid for pid in pids if pid not in journal_writer.done]
+        if not_done:
+            print('{} PIDs not done, because their updates failed or their metadata could not be '
+                  'fetched or fixed up. Rerun with --resume to retry them.'.format(len(not_done)), flush=True)
+        else:
+            # All the updates were made, so the journal is no longer needed
+            os.remove(journal)
 
 
 if __name__ == '__main__':